@@ -0,0 +1,140 @@
+"""
+This script times and memory-profiles the main functions of the three modules on synthetic
+feed pairs of several sizes, and appends the results to a JSON lines file.
+"""
+
+import io
+import os
+import json
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+import pandas as pd
+import Transit_Detect_Module as detect
+import Flow_Update_Module as flow
+import Seamless_Merge_Module as merge
+from Synthetic_Feed_Module import generate_feed_pair, change_rates
+from Stage_Metrics_Module import count_rows
+
+# -------------------------------------------
+# Define Size Tiers and Output
+# -------------------------------------------
+
+SIZE_TIERS = {
+    'small': {'routes': 10, 'trips': 500, 'stops': 300, 'shape_points': 100},
+    'medium': {'routes': 50, 'trips': 10000, 'stops': 3000, 'shape_points': 300},
+    'large': {'routes': 200, 'trips': 100000, 'stops': 20000, 'shape_points': 1000},
+}
+
+tiers = ['small', 'medium']
+
+# Results of every run are appended, one JSON object per line
+results_path = 'benchmark_results.jsonl'
+
+# Folder holding the generated feeds (empty = a temporary folder, removed afterwards)
+work_folder = ''
+
+# Memory tracing slows Python allocations down, switch it off for cleaner timings
+trace_memory = True
+
+# -------------------------------------------
+# Function to measure a stage
+# -------------------------------------------
+
+def measure(stage, function, *args, trace=True, **kwargs):
+
+    # Progress printed by the modules is kept out of the benchmark output
+    if trace:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    with redirect_stdout(io.StringIO()):
+        result = function(*args, **kwargs)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    peak = None
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    record = {
+        'stage': stage,
+        'wall_s': round(wall, 6),
+        'cpu_s': round(cpu, 6),
+        'peak_mb': round(peak / 2 ** 20, 3) if peak is not None else None,
+        'rows': count_rows(result),
+    }
+    return result, record
+
+# -------------------------------------------
+# Function to benchmark one size tier
+# -------------------------------------------
+
+def benchmark_tier(tier, size, folder, changes=None, seed=0, trace=True):
+    records = []
+
+    def run(stage, function, *args, **kwargs):
+        result, record = measure(stage, function, *args, trace=trace, **kwargs)
+        records.append(dict(record, tier=tier))
+        return result
+
+    folder1, folder2 = run('generate_feed_pair', generate_feed_pair, folder, size, changes, seed)
+
+    # Transit Detect
+    run('compare_folders', detect.compare_folders, folder1, folder2)
+
+    # Flow Update
+    stop_times1, trips1, stops1, calD1, cal1, agency1, routes1, shapes1 = run('load_data', flow.load_data, folder1)
+    stop_times2, trips2, stops2, calD2, cal2, agency2, routes2, shapes2 = run('load_data', flow.load_data, folder2)
+    run('detect_service_id_changes', flow.detect_service_id_changes, cal1, cal2, calD1, calD2)
+    trip_id_changes = run('detect_trip_id_changes', flow.detect_trip_id_changes,
+                          trips1, trips2, stop_times1, stop_times2)
+    run('detect_stop_id_changes', flow.detect_stop_id_changes, stops1, stops2, flow.stop_tolerance_m)
+    run('detect_route_id_changes', flow.detect_route_id_changes, routes1, routes2)
+    run('detect_shape_id_changes', flow.detect_shape_id_changes, shapes1, shapes2,
+        flow.shape_precision, flow.shape_tolerance_m)
+    run('verify_trips', flow.verify_trips, stop_times1, stop_times2, trips1, trips2, trip_id_changes)
+    del stop_times1, trips1, stops1, calD1, cal1, agency1, routes1, shapes1
+    del stop_times2, trips2, stops2, calD2, cal2, agency2, routes2, shapes2
+
+    # Seamless Merge
+    feeds = [run('load_gtfs_files', merge.load_gtfs_files, path) for path in (folder1, folder2)]
+    suffixed = [run('add_suffix_to_feed', merge.add_suffix_to_feed, feed, suffix)
+                for feed, suffix in zip(feeds, ['Feed_1', 'Feed_2'])]
+    del feeds
+    run('merge_feeds', merge.merge_feeds, suffixed)
+
+    return records
+
+def run_benchmarks(tier_names, results_file, folder='', changes=None, seed=0, trace=True):
+    run_info = {
+        'run': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+    }
+
+    temporary = not folder
+    folder = folder or tempfile.mkdtemp(prefix='gtfsync_benchmark_')
+    try:
+        with open(results_file, 'a', encoding='utf-8') as f:
+            for tier in tier_names:
+                print(f"\nBenchmarking {tier} feeds...")
+                records = benchmark_tier(tier, SIZE_TIERS[tier], os.path.join(folder, tier), changes, seed, trace)
+                for record in records:
+                    f.write(json.dumps(dict(run_info, **record)) + '\n')
+                    print(f" - {record['stage']}: {record['wall_s']:.3f} s wall, {record['cpu_s']:.3f} s CPU"
+                          + (f", {record['peak_mb']:.1f} MB peak" if record['peak_mb'] is not None else ""))
+    finally:
+        if temporary:
+            shutil.rmtree(folder, ignore_errors=True)
+
+# -------------------------------------------
+# Main Execution Logic
+# -------------------------------------------
+
+if __name__ == "__main__":
+    run_benchmarks(tiers, results_path, work_folder, change_rates, trace=trace_memory)
+    print(f"\nResults appended to {results_path}")
@@ -3,10 +3,17 @@ This script compares identifies and updates changes in unique identifiers
 """
 
 import os
+import sqlite3
+from contextlib import closing
+from difflib import SequenceMatcher
+import numpy as np
 import pandas as pd
+from GTFS_Feed_Module import (GTFS_FOREIGN_KEYS, feed_file_exists, read_gtfs_table, write_gtfs_table, remap_ids,
+                              remap_feed, ordered_group_signatures, configure_feed_cache)
+from Stage_Metrics_Module import measured_stage, start_metrics, stop_metrics
 
 # -------------------------------------------
-# Define Input Folders
+# Define Input Folders (folders or .zip archives)
 # -------------------------------------------
 
 input_folders = [
@@ -14,219 +21,782 @@ input_folders = [
    ''
 ]
 
+# Match trips sharing a route and service by their stop pattern when several are candidates
+break_trip_ties_by_stop_pattern = True
+
+# Largest distance in meters between two stops still considered for a match (0 = identical stops only)
+stop_tolerance_m = 25.0
+
+# Decimal places of the coordinates used to fingerprint shapes
+shape_precision = 6
+
+# Largest distance in meters between two shapes still treated as the same geometry
+shape_tolerance_m = 2.0
+
+# SQLite file keeping resolved mappings between runs, only new or changed entities are re-matched (None = off)
+mapping_store_path = None
+
+# Folder caching parsed tables between runs, needs pyarrow (None = off)
+feed_cache_folder = None
+
+# Size above which the least recently used cached tables are removed
+feed_cache_max_mb = 2048
+
+# File receiving per-stage timings and memory, Prometheus text for .prom, JSON otherwise (None = off)
+metrics_path = None
+
+# Stages profiled with cProfile ('*' = all), profiles are saved in profile_folder
+profile_stages = []
+profile_folder = ''
+
 # -------------------------------------------
 # Function to load data from files
 # -------------------------------------------
 
+@measured_stage
 def load_data(folder_name):
-    stop_times_path = os.path.join(folder_name, 'stop_times.txt')
-    trips_path = os.path.join(folder_name, 'trips.txt')
-    stops_path = os.path.join(folder_name, 'stops.txt')
-    calD_path = os.path.join(folder_name, 'calendar_dates.txt')
-    cal_path = os.path.join(folder_name, 'calendar.txt')
-    agency_path = os.path.join(folder_name, 'agency.txt')
-    routes_path = os.path.join(folder_name, 'routes.txt')
-    shapes_path = os.path.join(folder_name, 'shapes.txt')
-    
-    stop_times = pd.read_csv(stop_times_path)
-    trips = pd.read_csv(trips_path)
-    stops = pd.read_csv(stops_path)
-    calD = pd.read_csv(calD_path)
-    cal = pd.read_csv(cal_path)
-    agency = pd.read_csv(agency_path)
-    routes = pd.read_csv(routes_path)
-    shapes = pd.read_csv(shapes_path)
+    # folder_name may also be a .zip archive, members are read without extraction
+    stop_times = read_gtfs_table(folder_name, 'stop_times.txt')
+    trips = read_gtfs_table(folder_name, 'trips.txt')
+    stops = read_gtfs_table(folder_name, 'stops.txt')
+    # A feed may define its services with either calendar file alone
+    calD = read_gtfs_table(folder_name, 'calendar_dates.txt') if feed_file_exists(folder_name, 'calendar_dates.txt') else None
+    cal = read_gtfs_table(folder_name, 'calendar.txt') if feed_file_exists(folder_name, 'calendar.txt') else None
+    agency = read_gtfs_table(folder_name, 'agency.txt')
+    routes = read_gtfs_table(folder_name, 'routes.txt')
+    shapes = read_gtfs_table(folder_name, 'shapes.txt')
     
     return stop_times, trips, stops, calD, cal, agency, routes, shapes
 
+# Tables outside load_data that reference remapped identifiers (transfers, frequencies...)
+FEED_TABLES = ['stop_times.txt', 'trips.txt', 'stops.txt', 'calendar_dates.txt', 'calendar.txt',
+               'agency.txt', 'routes.txt', 'shapes.txt']
+
+@measured_stage
+def load_referencing_tables(folder_name):
+    return {file_name: read_gtfs_table(folder_name, file_name) for file_name in GTFS_FOREIGN_KEYS
+            if file_name not in FEED_TABLES and feed_file_exists(folder_name, file_name)}
+
 # -------------------------------------------
 # Functions to detect changes in unique identifiers
 # -------------------------------------------
 
-def detect_service_id_changes(cal1, cal2):
-    merged_cal = pd.merge(cal1, cal2, on=list(cal1.columns.difference(['service_id'])), suffixes=('_feed1', '_feed2'), how='outer')
-    service_id_mapping = merged_cal[['service_id_feed1', 'service_id_feed2']].dropna()
-    return dict(zip(service_id_mapping['service_id_feed1'], service_id_mapping['service_id_feed2']))
-
-def detect_trip_id_changes(trips1, trips2):
-    trip_id_change_map = {}
-    trips2_indexed = trips2.set_index(['route_id', 'service_id', 'trip_id'])
-    
-    for _, row1 in trips1.iterrows():
-        key = (row1['route_id'], row1['service_id'], row1['trip_id'])
-        if key in trips2_indexed.index:
-            # Trip IDs are identical, no change needed.
-            continue
-        else:
-            # Check for matching route_id and service_id but different trip_id
-            matching_trips = trips2[
-                (trips2['route_id'] == row1['route_id']) &
-                (trips2['service_id'] == row1['service_id'])
-            ]
-            if len(matching_trips) == 1:
-                new_trip_id = matching_trips.iloc[0]['trip_id']
-                trip_id_change_map[row1['trip_id']] = new_trip_id
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+# Days of unreadable dates, before any real date so they fall outside every window
+INVALID_DAY = np.iinfo(np.int64).min
+
+def _gtfs_days(dates):
+    # YYYYMMDD values to days since 1970-01-01. numpy's day unit reaches the open-ended
+    # 99991231 that pandas timestamps in nanoseconds cannot hold.
+    values = pd.to_numeric(pd.Series(dates), errors='coerce').to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0).astype(np.int64)
+    year, month, day = values // 10000, values // 100 % 100, values % 100
+    valid &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+    months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    days = months.astype('datetime64[D]').astype(np.int64) + day - 1
+    # Days past the end of their month, such as 20240231, are as unreadable as text
+    valid &= days.astype('datetime64[D]').astype('datetime64[M]') == months
+    return np.where(valid, days, INVALID_DAY)
+
+def service_date_range(cal, calD):
+    days = []
+    if cal is not None and len(cal):
+        days += [_gtfs_days(cal['start_date']), _gtfs_days(cal['end_date'])]
+    if calD is not None and len(calD):
+        days.append(_gtfs_days(calD['date']))
+    days = np.concatenate(days) if days else np.array([], dtype=np.int64)
+    days = days[days >= 0] if len(days) else days
+    return (int(days.min()), int(days.max())) if len(days) else None
+
+def service_sample_days(first_day, last_day, *calendars):
+
+    # Between the dates where a calendar starts or ends or an exception falls, every
+    # service repeats week after week. The first week after each of these dates tells
+    # the whole window apart, however far an open-ended end_date such as 20991231 lies.
+    breaks = [np.array([first_day], dtype=np.int64)]
+    for cal, calD in calendars:
+        if cal is not None and len(cal):
+            breaks += [_gtfs_days(cal['start_date']), _gtfs_days(cal['end_date']) + 1]
+        if calD is not None and len(calD):
+            exception_days = _gtfs_days(calD['date'])
+            breaks += [exception_days, exception_days + 1]
+    breaks = np.unique(np.concatenate(breaks))
+    breaks = breaks[(breaks >= first_day) & (breaks <= last_day)]
+    days = np.unique((breaks[:, None] + np.arange(7)).ravel())
+    return days[days <= last_day]
+
+def service_active_dates(cal, calD, window):
+
+    # One row of bits per service, one bit per sampled day, packed 8 days to a byte
+    ids = []
+    if cal is not None:
+        ids.append(cal['service_id'].astype(str).to_numpy())
+    if calD is not None:
+        ids.append(calD['service_id'].astype(str).to_numpy())
+    service_ids = pd.unique(np.concatenate(ids)) if ids else np.array([], dtype=object)
+    service_ids = service_ids[pd.notna(service_ids)]
+    active = np.zeros((len(service_ids), len(window)), dtype=bool)
+    rows = pd.Index(service_ids)
+
+    if cal is not None and len(cal):
+        row = rows.get_indexer(cal['service_id'].astype(str))
+        # 1970-01-01 was a Thursday
+        weekday = (window + 3) % 7
+        flags = np.column_stack([pd.to_numeric(cal[day], errors='coerce').fillna(0).to_numpy() == 1
+                                 for day in WEEKDAYS])
+        start = _gtfs_days(cal['start_date'])
+        end = _gtfs_days(cal['end_date'])
+        active[row] |= (flags[:, weekday] & (window >= start[:, None]) & (window <= end[:, None]))
+
+    # Exceptions: 1 adds the date, 2 removes it
+    if calD is not None and len(calD):
+        row = rows.get_indexer(calD['service_id'].astype(str))
+        exception_days = _gtfs_days(calD['date'])
+        day = np.minimum(np.searchsorted(window, exception_days), len(window) - 1)
+        exception = pd.to_numeric(calD['exception_type'], errors='coerce').to_numpy()
+        inside = (row >= 0) & (window[day] == exception_days)
+        active[row[inside & (exception == 1)], day[inside & (exception == 1)]] = True
+        active[row[inside & (exception == 2)], day[inside & (exception == 2)]] = False
+
+    packed = np.packbits(active, axis=1)
+    return pd.Series([bits.tobytes() for bits in packed], index=rows, dtype=object), active.any(axis=1)
+
+@measured_stage
+def detect_service_id_changes(cal1, cal2, calD1=None, calD2=None):
+
+    # Services are compared on the dates they run, over the window both feeds cover.
+    # Rolling feeds are shifted in time, over the union the same service never looks the same.
+    ranges = [r for r in (service_date_range(cal1, calD1), service_date_range(cal2, calD2)) if r]
+    if not ranges:
+        return {}
+    first_day = max(r[0] for r in ranges)
+    last_day = min(r[1] for r in ranges)
+    if first_day > last_day:
+        # Windows that do not overlap fall back to the union
+        first_day = min(r[0] for r in ranges)
+        last_day = max(r[1] for r in ranges)
+    window = service_sample_days(first_day, last_day, (cal1, calD1), (cal2, calD2))
+    bitsets1, running1 = service_active_dates(cal1, calD1, window)
+    bitsets2, running2 = service_active_dates(cal2, calD2, window)
+
+    # Services that never run carry no meaning to match on
+    bitsets1 = bitsets1[running1]
+    bitsets2 = bitsets2[running2]
+    return _pair_by_key(bitsets1.index, bitsets1.to_numpy(), bitsets2.index, bitsets2.to_numpy())
+
+def stop_pattern_signatures(stop_times):
+    return ordered_group_signatures(stop_times, 'trip_id', 'stop_sequence', ['stop_id'])
+
+@measured_stage
+def detect_trip_id_changes(trips1, trips2, stop_times1=None, stop_times2=None):
+    keys = ['route_id', 'service_id', 'trip_id']
+    group = ['route_id', 'service_id']
+
+    # Trips found with the same route, service and trip_id in both feeds keep their ID
+    index1 = pd.MultiIndex.from_frame(trips1[keys])
+    index2 = pd.MultiIndex.from_frame(trips2[keys])
+    unmatched1 = trips1.loc[~index1.isin(index2), keys]
+    unmatched2 = trips2.loc[~index2.isin(index1), keys]
+
+    # A route and service with a single unmatched trip on each side is a renamed trip
+    count1 = unmatched1.groupby(group)['trip_id'].transform('size')
+    count2 = unmatched2.groupby(group)['trip_id'].transform('size')
+    renamed = pd.merge(unmatched1[count1 == 1], unmatched2[count2 == 1], on=group, suffixes=('_feed1', '_feed2'))
+    trip_id_change_map = dict(zip(renamed['trip_id_feed1'], renamed['trip_id_feed2']))
+
+    if stop_times1 is None or stop_times2 is None:
+        return trip_id_change_map
+
+    # Several candidates: pair the trips whose stop pattern is unique within the group
+    tied1 = unmatched1[(count1 > 1).to_numpy()]
+    tied2 = unmatched2[(count2 > 1).to_numpy()]
+    tied1 = tied1.assign(signature=tied1['trip_id'].map(
+        stop_pattern_signatures(stop_times1[stop_times1['trip_id'].isin(tied1['trip_id'])]))).dropna()
+    tied2 = tied2.assign(signature=tied2['trip_id'].map(
+        stop_pattern_signatures(stop_times2[stop_times2['trip_id'].isin(tied2['trip_id'])]))).dropna()
+
+    pattern = group + ['signature']
+    tied1 = tied1[tied1.groupby(pattern)['trip_id'].transform('size') == 1]
+    tied2 = tied2[tied2.groupby(pattern)['trip_id'].transform('size') == 1]
+    renamed = pd.merge(tied1, tied2, on=pattern, suffixes=('_feed1', '_feed2'))
+    trip_id_change_map.update(zip(renamed['trip_id_feed1'], renamed['trip_id_feed2']))
 
     return trip_id_change_map
 
 
-def detect_stop_id_changes(stops1, stops2):
-    common_columns = list(stops1.columns.difference(['stop_id']))
-    merged_stops = pd.merge(stops1, stops2, on=common_columns, suffixes=('_feed1', '_feed2'), how='outer')
-    stop_id_mapping = merged_stops[['stop_id_feed1', 'stop_id_feed2']].dropna()
-    return dict(zip(stop_id_mapping['stop_id_feed1'], stop_id_mapping['stop_id_feed2']))
-
+# Attributes that count towards the score of two nearby stops, next to their names
+STOP_MATCH_ATTRIBUTES = ['stop_code', 'platform_code', 'location_type', 'wheelchair_boarding']
+
+def _name_similarity(names1, names2):
+    return np.array([1.0 if a == b else SequenceMatcher(None, a, b).ratio() for a, b in zip(names1, names2)])
+
+def _match_stops_within_tolerance(stops1, stops2, tolerance_m, min_name_similarity=0.5):
+    attributes = [col for col in STOP_MATCH_ATTRIBUTES if col in stops1.columns and col in stops2.columns]
+    stops1 = stops1.dropna(subset=['stop_lat', 'stop_lon'])
+    stops2 = stops2.dropna(subset=['stop_lat', 'stop_lon'])
+    if len(stops1) == 0 or len(stops2) == 0:
+        return {}
+
+    # Equirectangular projection to meters, then a grid with cells the size of the tolerance
+    origin_lat = float(pd.concat([stops1['stop_lat'], stops2['stop_lat']]).astype(float).mean())
+    def located(stops):
+        x = stops['stop_lon'].to_numpy(dtype=float) * 111320.0 * np.cos(np.radians(origin_lat))
+        y = stops['stop_lat'].to_numpy(dtype=float) * 110574.0
+        names = stops['stop_name'] if 'stop_name' in stops.columns else pd.Series('', index=stops.index)
+        return pd.DataFrame({
+            'stop_id': stops['stop_id'].to_numpy(dtype=object),
+            'x': x, 'y': y,
+            'cell_x': np.floor(x / tolerance_m).astype(np.int64),
+            'cell_y': np.floor(y / tolerance_m).astype(np.int64),
+            'name': names.astype(str).str.strip().str.lower().to_numpy(dtype=object),
+            **{col: stops[col].astype(str).to_numpy(dtype=object) for col in attributes},
+        })
+    located1 = located(stops1)
+    located2 = located(stops2)
+
+    # Candidates are the stops of the same or a neighbouring cell within the tolerance
+    candidates = pd.concat([
+        pd.merge(located1.assign(cell_x=located1['cell_x'] + dx, cell_y=located1['cell_y'] + dy), located2,
+                 on=['cell_x', 'cell_y'], suffixes=('_feed1', '_feed2'))
+        for dx in (-1, 0, 1) for dy in (-1, 0, 1)], ignore_index=True)
+    distance = np.hypot(candidates['x_feed1'] - candidates['x_feed2'], candidates['y_feed1'] - candidates['y_feed2'])
+    candidates = candidates[(distance <= tolerance_m).to_numpy()].assign(distance=distance)
+    if len(candidates) == 0:
+        return {}
+
+    name_score = _name_similarity(candidates['name_feed1'], candidates['name_feed2'])
+    similar = name_score >= min_name_similarity
+    candidates = candidates[similar].assign(name_score=name_score[similar])
+    attribute_score = np.mean([(candidates[f'{col}_feed1'] == candidates[f'{col}_feed2']).to_numpy()
+                               for col in attributes], axis=0) if attributes else 0.0
+    candidates = candidates.assign(score=candidates['name_score'] + 0.5 * attribute_score
+                                   - 0.25 * candidates['distance'] / tolerance_m)
+
+    # Best scoring pairs first, each stop is used at most once
+    stop_id_mapping = {}
+    used = set()
+    ordered = candidates.sort_values(['score', 'distance'], ascending=[False, True], kind='stable')
+    for stop_id1, stop_id2 in zip(ordered['stop_id_feed1'], ordered['stop_id_feed2']):
+        if stop_id1 not in stop_id_mapping and stop_id2 not in used:
+            stop_id_mapping[stop_id1] = stop_id2
+            used.add(stop_id2)
+    return stop_id_mapping
+
+@measured_stage
+def detect_stop_id_changes(stops1, stops2, tolerance_m=25.0):
+
+    # Stops identical in every other column are paired through their row hashes
+    columns = sorted((set(stops1.columns) & set(stops2.columns)) - {'stop_id'})
+    hashes1 = pd.util.hash_pandas_object(stops1[columns], index=False).to_numpy()
+    hashes2 = pd.util.hash_pandas_object(stops2[columns], index=False).to_numpy()
+    stop_id_mapping = _pair_by_key(stops1['stop_id'].to_numpy(dtype=object), hashes1,
+                                   stops2['stop_id'].to_numpy(dtype=object), hashes2)
+
+    # Remaining stops are matched by position, name and attributes
+    if tolerance_m and {'stop_lat', 'stop_lon'} <= set(columns):
+        unmatched1 = stops1[~stops1['stop_id'].isin(list(stop_id_mapping.keys()))]
+        unmatched2 = stops2[~stops2['stop_id'].isin(list(stop_id_mapping.values()))]
+        stop_id_mapping.update(_match_stops_within_tolerance(unmatched1, unmatched2, tolerance_m))
+
+    return stop_id_mapping
+
+@measured_stage
 def detect_route_id_changes(routes1, routes2):
     common_columns = list(routes1.columns.difference(['route_id']))
     merged_routes = pd.merge(routes1, routes2, on=common_columns, suffixes=('_feed1', '_feed2'), how='outer')
     route_id_mapping = merged_routes[['route_id_feed1', 'route_id_feed2']].dropna()
     return dict(zip(route_id_mapping['route_id_feed1'], route_id_mapping['route_id_feed2']))
 
-def detect_shape_id_changes(shapes1, shapes2):
+def shape_fingerprints(shapes, precision=6):
+    scale = 10 ** precision
+    quantized = pd.DataFrame({
+        'shape_id': shapes['shape_id'].to_numpy(),
+        'shape_pt_sequence': shapes['shape_pt_sequence'].to_numpy(),
+        'lat': np.round(shapes['shape_pt_lat'].to_numpy(dtype=float) * scale).astype(np.int64),
+        'lon': np.round(shapes['shape_pt_lon'].to_numpy(dtype=float) * scale).astype(np.int64),
+    })
+    return ordered_group_signatures(quantized, 'shape_id', 'shape_pt_sequence', ['lat', 'lon'])
+
+def _pair_by_key(ids1, keys1, ids2, keys2):
+
+    # One-to-one pairing of IDs sharing a key, identical IDs are paired first
+    df1 = pd.DataFrame({'id': ids1, 'key': keys1})
+    df2 = pd.DataFrame({'id': ids2, 'key': keys2})
+    same = pd.merge(df1, df2, on=['id', 'key'])
+    df1 = df1[~df1['id'].isin(same['id'])]
+    df2 = df2[~df2['id'].isin(same['id'])]
+    df1 = df1.assign(rank=df1.groupby('key').cumcount())
+    df2 = df2.assign(rank=df2.groupby('key').cumcount())
+    paired = pd.merge(df1, df2, on=['key', 'rank'], suffixes=('_feed1', '_feed2'))
+    mapping = dict(zip(same['id'], same['id']))
+    mapping.update(zip(paired['id_feed1'], paired['id_feed2']))
+    return mapping
+
+def _projected_shapes(shapes, shape_ids, origin_lat):
+
+    # Equirectangular projection to meters, accurate enough at shape scale
+    subset = shapes[shapes['shape_id'].isin(shape_ids)].sort_values(['shape_id', 'shape_pt_sequence'])
+    x = subset['shape_pt_lon'].to_numpy(dtype=float) * 111320.0 * np.cos(np.radians(origin_lat))
+    y = subset['shape_pt_lat'].to_numpy(dtype=float) * 110574.0
+    ids = subset['shape_id'].to_numpy()
+    if len(ids) == 0:
+        return {}
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    points = np.split(np.column_stack([x, y]), starts[1:])
+    return dict(zip(ids[starts], points))
+
+def _directed_hausdorff(a, b, limit, block_size=1 << 21):
+
+    # Largest distance from a point of a to the nearest point of b, stops early above limit
+    rows = max(1, block_size // len(b))
+    worst = 0.0
+    for start in range(0, len(a), rows):
+        block = a[start:start + rows]
+        nearest = np.sqrt(((block[:, None, :] - b[None, :, :]) ** 2).sum(axis=2).min(axis=1))
+        worst = max(worst, nearest.max())
+        if worst > limit:
+            break
+    return worst
+
+def _match_shapes_within_tolerance(shapes1, ids1, shapes2, ids2, tolerance_m):
+    if len(ids1) == 0 or len(ids2) == 0:
+        return {}
+
+    origin_lat = float(pd.concat([shapes1['shape_pt_lat'], shapes2['shape_pt_lat']]).astype(float).mean())
+    points1 = _projected_shapes(shapes1, ids1, origin_lat)
+    points2 = _projected_shapes(shapes2, ids2, origin_lat)
+
+    # Shapes within the tolerance have bounding boxes within the tolerance, so
+    # candidates are looked up in a grid of bounding-box corners
+    def bbox(points):
+        return np.concatenate([points.min(axis=0), points.max(axis=0)])
+
+    boxes2 = {shape_id: bbox(points) for shape_id, points in points2.items()}
+    grid = {}
+    for shape_id, box in boxes2.items():
+        cell = (int(box[0] // tolerance_m), int(box[1] // tolerance_m))
+        grid.setdefault(cell, []).append(shape_id)
+
+    candidates = []
+    for shape_id1, a in points1.items():
+        box1 = bbox(a)
+        cell_x, cell_y = int(box1[0] // tolerance_m), int(box1[1] // tolerance_m)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for shape_id2 in grid.get((cell_x + dx, cell_y + dy), []):
+                    b = points2[shape_id2]
+                    if np.abs(boxes2[shape_id2] - box1).max() > tolerance_m:
+                        continue
+                    # Same direction of travel: the endpoints must line up too
+                    if max(np.hypot(*(a[0] - b[0])), np.hypot(*(a[-1] - b[-1]))) > tolerance_m:
+                        continue
+                    distance = max(_directed_hausdorff(a, b, tolerance_m), _directed_hausdorff(b, a, tolerance_m))
+                    if distance <= tolerance_m:
+                        candidates.append((distance, shape_id1, shape_id2))
+
+    # Closest pairs first, each shape is used at most once
     shape_id_mapping = {}
+    used = set()
+    for distance, shape_id1, shape_id2 in sorted(candidates, key=lambda c: c[0]):
+        if shape_id1 not in shape_id_mapping and shape_id2 not in used:
+            shape_id_mapping[shape_id1] = shape_id2
+            used.add(shape_id2)
+    return shape_id_mapping
 
-    # Generate CSV representations of shapes from feed2
-    shapes2_groups = {
-        shape_id: group[['shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence']].to_csv(index=False)
-        for shape_id, group in shapes2.groupby('shape_id')
-    }
-
-    # Compare each shape from feed1 to shapes in feed2
-    for shape_id1, group1 in shapes1.groupby('shape_id'):
-        shape1_csv = group1[['shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence']].to_csv(index=False)
+@measured_stage
+def detect_shape_id_changes(shapes1, shapes2, precision=6, tolerance_m=2.0):
 
-        matched = False
-        for shape_id2, shape2_csv in shapes2_groups.items():
-            if shape1_csv == shape2_csv:
-                # Identical shapes; retain original ID
-                shape_id_mapping[shape_id1] = shape_id1
-                matched = True
-                break
+    # Exact matches through the fingerprint index
+    fingerprints1 = shape_fingerprints(shapes1, precision)
+    fingerprints2 = shape_fingerprints(shapes2, precision)
+    shape_id_mapping = _pair_by_key(fingerprints1.index, fingerprints1.to_numpy(),
+                                    fingerprints2.index, fingerprints2.to_numpy())
 
-        if not matched:
-            # No identical match found; shape_id remains unchanged
-            pass
+    # Remaining shapes are compared geometrically
+    if tolerance_m:
+        unmatched1 = fingerprints1.index[~fingerprints1.index.isin(list(shape_id_mapping.keys()))]
+        unmatched2 = fingerprints2.index[~fingerprints2.index.isin(list(shape_id_mapping.values()))]
+        shape_id_mapping.update(_match_shapes_within_tolerance(shapes1, unmatched1, shapes2, unmatched2, tolerance_m))
 
     return shape_id_mapping
 
 
+# -------------------------------------------
+# Persistent mapping store
+# -------------------------------------------
+
+MAPPING_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS id_mappings (
+    entity TEXT NOT NULL,
+    id_feed1 TEXT NOT NULL,
+    hash_feed1 INTEGER NOT NULL,
+    id_feed2 TEXT NOT NULL,
+    hash_feed2 INTEGER NOT NULL,
+    PRIMARY KEY (entity, id_feed1, hash_feed1)
+);
+CREATE TABLE IF NOT EXISTS entity_versions (
+    entity TEXT NOT NULL,
+    id TEXT NOT NULL,
+    hash INTEGER NOT NULL,
+    lineage INTEGER NOT NULL,
+    PRIMARY KEY (entity, id, hash)
+);
+CREATE INDEX IF NOT EXISTS entity_versions_lineage ON entity_versions (entity, lineage);
+CREATE TEMP TABLE IF NOT EXISTS current_versions (
+    id TEXT NOT NULL,
+    hash INTEGER NOT NULL
+);
+"""
+
+def open_mapping_store(path):
+    connection = sqlite3.connect(path)
+    connection.executescript(MAPPING_STORE_SCHEMA)
+
+    # Stores written before lineages were kept get them once, from their decisions
+    has_versions = connection.execute("SELECT 1 FROM entity_versions LIMIT 1").fetchone()
+    has_mappings = connection.execute("SELECT 1 FROM id_mappings LIMIT 1").fetchone()
+    if has_mappings and not has_versions:
+        stored = pd.read_sql_query(
+            "SELECT entity, id_feed1, hash_feed1, id_feed2, hash_feed2 FROM id_mappings", connection)
+        versions = []
+        for entity, decisions in stored.groupby('entity'):
+            lineages = mapping_lineages(decisions)
+            numbers = pd.Series(pd.factorize(lineages)[0] + 1, index=lineages.index)
+            for version, lineage in numbers.items():
+                entity_id, entity_hash = version.rsplit('\x1f', 1)
+                versions.append((entity, entity_id, int(entity_hash), int(lineage)))
+        connection.executemany("INSERT INTO entity_versions VALUES (?, ?, ?, ?)", versions)
+        connection.commit()
+    return connection
+
+def _hash_series(hashes, ids):
+    # SQLite integers are signed, hashes are stored with the same bits as int64
+    hashes = pd.Series(np.asarray(hashes, dtype=np.uint64).view(np.int64), index=pd.Index(ids).astype(str))
+    return hashes[~hashes.index.duplicated()]
+
+def content_hashes(df, id_column):
+    columns = sorted(col for col in df.columns if col != id_column)
+    return _hash_series(pd.util.hash_pandas_object(df[columns], index=False).to_numpy(), df[id_column])
+
+def trip_content_hashes(trips, stop_times):
+    # A trip is matched on its route, service and stop pattern, all of them are part of its content
+    rows = content_hashes(trips, 'trip_id')
+    patterns = stop_pattern_signatures(stop_times)
+    patterns.index = patterns.index.astype(str)
+    combined = pd.DataFrame({
+        'row': rows.to_numpy(),
+        'pattern': patterns.reindex(rows.index).fillna(0).to_numpy(dtype=np.uint64),
+    })
+    return _hash_series(pd.util.hash_pandas_object(combined, index=False).to_numpy(), rows.index)
+
+def service_content_hashes(cal, calD):
+    # A service is its calendar row together with its exceptions
+    parts = []
+    if cal is not None:
+        parts.append(content_hashes(cal, 'service_id').rename('calendar'))
+    if calD is not None:
+        exceptions = ordered_group_signatures(calD, 'service_id', 'date', ['date', 'exception_type'])
+        exceptions.index = exceptions.index.astype(str)
+        parts.append(exceptions.rename('calendar_dates'))
+    if not parts:
+        return pd.Series(dtype=np.int64)
+    services = pd.concat(parts, axis=1).astype(str)
+    return _hash_series(pd.util.hash_pandas_object(services, index=False).to_numpy(), services.index)
+
+def shape_content_hashes(shapes, precision=6):
+    fingerprints = shape_fingerprints(shapes, precision)
+    return _hash_series(fingerprints.to_numpy(dtype=np.uint64), fingerprints.index)
+
+def _version_keys(ids, hashes):
+    # One key per version of an entity, its ID together with its content
+    return ids.astype(str) + '\x1f' + hashes.astype(str)
+
+def mapping_lineages(stored):
+
+    # Each stored decision links two versions of one entity. Decisions taken on earlier
+    # feed pairs share versions with each other (last week's feed2 is this week's feed1),
+    # linked together they trace every version an entity went through.
+    versions1 = _version_keys(stored['id_feed1'], stored['hash_feed1']).tolist()
+    versions2 = _version_keys(stored['id_feed2'], stored['hash_feed2']).tolist()
+    parent = {}
+
+    def find(version):
+        root = version
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while version != root:
+            parent[version], version = root, parent[version]
+        return root
+
+    for version1, version2 in zip(versions1, versions2):
+        root1, root2 = find(version1), find(version2)
+        if root1 != root2:
+            parent[root1] = root2
+    return pd.Series({version: find(version) for version in versions1 + versions2}, dtype=object)
+
+def lookup_lineages(connection, entity, hashes):
+
+    # Only the versions at hand are looked up, the store grows with every run
+    connection.execute("DELETE FROM current_versions")
+    connection.executemany("INSERT INTO current_versions VALUES (?, ?)",
+                           zip(hashes.index, hashes.to_numpy().tolist()))
+    found = pd.read_sql_query(
+        "SELECT v.id, v.lineage FROM current_versions c JOIN entity_versions v "
+        "ON v.entity = ? AND v.id = c.id AND v.hash = c.hash", connection, params=(entity,))
+    return pd.Series(found['lineage'].to_numpy(), index=found['id'].astype(str), dtype=np.int64)
+
+def record_lineages(connection, entity, decisions, hashes1, hashes2, lineage1):
+
+    # The feed2 version joins the lineage of the feed1 version, a lineage already held
+    # by the feed2 version is merged into it
+    next_lineage = connection.execute(
+        "SELECT COALESCE(MAX(lineage), 0) + 1 FROM entity_versions WHERE entity = ?", (entity,)).fetchone()[0]
+    for id1, id2 in decisions.items():
+        lineage = lineage1.get(id1)
+        if lineage is None:
+            lineage, next_lineage = next_lineage, next_lineage + 1
+            connection.execute("INSERT OR REPLACE INTO entity_versions VALUES (?, ?, ?, ?)",
+                               (entity, id1, int(hashes1[id1]), int(lineage)))
+        held = connection.execute("SELECT lineage FROM entity_versions WHERE entity = ? AND id = ? AND hash = ?",
+                                  (entity, id2, int(hashes2[id2]))).fetchone()
+        if held is None:
+            connection.execute("INSERT INTO entity_versions VALUES (?, ?, ?, ?)",
+                               (entity, id2, int(hashes2[id2]), int(lineage)))
+        elif held[0] != lineage:
+            connection.execute("UPDATE entity_versions SET lineage = ? WHERE entity = ? AND lineage = ?",
+                               (int(lineage), entity, held[0]))
+
+def resolve_id_changes(connection, entity, hashes1, hashes2, detect):
+
+    # Entities kept unchanged under the same ID need no matching
+    common = hashes1.index.intersection(hashes2.index)
+    unchanged = common[hashes1[common].to_numpy() == hashes2[common].to_numpy()]
+    changed1 = hashes1.index.difference(unchanged)
+    changed2 = hashes2.index.difference(unchanged)
+
+    # Prior decisions hold for the versions they recorded, in either direction and chained
+    # across runs. A lineage found once in each feed pairs its two entities.
+    lineage1 = lookup_lineages(connection, entity, hashes1[changed1])
+    lineage2 = lookup_lineages(connection, entity, hashes2[changed2])
+    linked1 = pd.DataFrame({'id_feed1': lineage1.index, 'lineage': lineage1.to_numpy()})
+    linked2 = pd.DataFrame({'id_feed2': lineage2.index, 'lineage': lineage2.to_numpy()})
+    linked1 = linked1[~linked1['lineage'].duplicated(keep=False)]
+    linked2 = linked2[~linked2['lineage'].duplicated(keep=False)]
+    reused_pairs = pd.merge(linked1, linked2, on='lineage')
+    reused = dict(zip(reused_pairs['id_feed1'], reused_pairs['id_feed2']))
+
+    # Only new or changed entities go through the matching
+    pending1 = changed1.difference(reused_pairs['id_feed1'])
+    pending2 = changed2.difference(reused_pairs['id_feed2'])
+    detected = {}
+    if len(pending1) and len(pending2):
+        detected = {str(id1): str(id2) for id1, id2 in detect(pending1, pending2).items()
+                    if str(id1) in hashes1.index and str(id2) in hashes2.index}
+
+    connection.executemany(
+        "INSERT OR REPLACE INTO id_mappings VALUES (?, ?, ?, ?, ?)",
+        [(entity, id1, int(hashes1[id1]), id2, int(hashes2[id2])) for id1, id2 in detected.items()])
+    record_lineages(connection, entity, detected, hashes1, hashes2, lineage1)
+    connection.commit()
+
+    print(f" - {entity}: {len(unchanged)} unchanged, {len(reused)} reused, "
+          f"{len(pending1)} matched of which {len(detected)} found")
+    detected.update(reused)
+    return detected
+
+def _restrict(df, id_column, ids):
+    if df is None:
+        return None
+    return df[df[id_column].astype(str).isin(ids)]
+
+@measured_stage
+def detect_id_changes_with_store(connection, calendars, calendar_dates, trips, stop_times, stops, routes, shapes,
+                                 break_ties=True, stop_tolerance_m=25.0, precision=6, tolerance_m=2.0):
+    # Each table argument is a (feed1, feed2) pair
+    print("\nMatching identifiers against the mapping store:")
+    service_id_changes = resolve_id_changes(
+        connection, 'service', service_content_hashes(calendars[0], calendar_dates[0]),
+        service_content_hashes(calendars[1], calendar_dates[1]),
+        lambda ids1, ids2: detect_service_id_changes(_restrict(calendars[0], 'service_id', ids1),
+                                                     _restrict(calendars[1], 'service_id', ids2),
+                                                     _restrict(calendar_dates[0], 'service_id', ids1),
+                                                     _restrict(calendar_dates[1], 'service_id', ids2)))
+    trip_id_changes = resolve_id_changes(
+        connection, 'trip', trip_content_hashes(trips[0], stop_times[0]), trip_content_hashes(trips[1], stop_times[1]),
+        lambda ids1, ids2: detect_trip_id_changes(_restrict(trips[0], 'trip_id', ids1),
+                                                  _restrict(trips[1], 'trip_id', ids2),
+                                                  *(stop_times if break_ties else (None, None))))
+    stop_id_changes = resolve_id_changes(
+        connection, 'stop', content_hashes(stops[0], 'stop_id'), content_hashes(stops[1], 'stop_id'),
+        lambda ids1, ids2: detect_stop_id_changes(_restrict(stops[0], 'stop_id', ids1),
+                                                  _restrict(stops[1], 'stop_id', ids2), stop_tolerance_m))
+    route_id_changes = resolve_id_changes(
+        connection, 'route', content_hashes(routes[0], 'route_id'), content_hashes(routes[1], 'route_id'),
+        lambda ids1, ids2: detect_route_id_changes(_restrict(routes[0], 'route_id', ids1),
+                                                   _restrict(routes[1], 'route_id', ids2)))
+    shape_id_changes = resolve_id_changes(
+        connection, 'shape', shape_content_hashes(shapes[0], precision), shape_content_hashes(shapes[1], precision),
+        lambda ids1, ids2: detect_shape_id_changes(_restrict(shapes[0], 'shape_id', ids1),
+                                                   _restrict(shapes[1], 'shape_id', ids2), precision, tolerance_m))
+    return service_id_changes, trip_id_changes, stop_id_changes, route_id_changes, shape_id_changes
+
 # -------------------------------------------
 # Updating Functions
 # -------------------------------------------
 
+@measured_stage
 def update_service_ids_in_calendar_dates(calendar_dates, service_id_mapping):
-    calendar_dates['service_id'] = calendar_dates['service_id'].replace(service_id_mapping)
+    calendar_dates['service_id'] = remap_ids(calendar_dates['service_id'], service_id_mapping)
     return calendar_dates
 
+@measured_stage
 def update_service_ids_in_trips(trips, service_id_mapping):
-    trips['service_id'] = trips['service_id'].replace(service_id_mapping)
+    trips['service_id'] = remap_ids(trips['service_id'], service_id_mapping)
     return trips
 
+@measured_stage
 def update_route_ids_in_trips(trips, route_id_mapping):
-    trips['route_id'] = trips['route_id'].replace(route_id_mapping)
+    trips['route_id'] = remap_ids(trips['route_id'], route_id_mapping)
     return trips
 
+@measured_stage
 def update_shape_ids_in_trips(trips, shape_id_mapping):
-    trips['shape_id'] = trips['shape_id'].replace(shape_id_mapping)
+    trips['shape_id'] = remap_ids(trips['shape_id'], shape_id_mapping)
     return trips
 
+@measured_stage
 def update_stop_times_ids(stop_times, trip_id_mapping, stop_id_mapping):
-    stop_times['trip_id'] = stop_times['trip_id'].replace(trip_id_mapping)
-    stop_times['stop_id'] = stop_times['stop_id'].replace(stop_id_mapping)
+    stop_times['trip_id'] = remap_ids(stop_times['trip_id'], trip_id_mapping)
+    stop_times['stop_id'] = remap_ids(stop_times['stop_id'], stop_id_mapping)
     return stop_times
 
 # -------------------------------------------
 # Trips Verification Process
 # -------------------------------------------
 
-def verify_trips(feed1_stop_times, feed2_stop_times, feed1_trips, feed2_trips):
-    print("\nStarting trips verification...")
-    identical_trips = []
-    changed_identical_trips = []
-    different_trips = []
-
-    trip_id_changes = detect_trip_id_changes(feed1_trips, feed2_trips)
+def trip_signatures(stop_times):
+    columns = [col for col in ['stop_id', 'arrival_time', 'departure_time', 'stop_sequence'] if col in stop_times.columns]
+    return ordered_group_signatures(stop_times, 'trip_id', 'stop_sequence', columns)
 
-    for trip_id1 in feed1_trips["trip_id"]:
-        trip_id2 = trip_id_changes.get(trip_id1, trip_id1)
-
-        stop_times1 = feed1_stop_times[feed1_stop_times["trip_id"] == trip_id1]
-        stop_times2 = feed2_stop_times[feed2_stop_times["trip_id"] == trip_id2]
+@measured_stage
+def verify_trips(feed1_stop_times, feed2_stop_times, feed1_trips, feed2_trips, trip_id_changes=None):
+    print("\nStarting trips verification...")
 
-        are_identical = stop_times1.equals(stop_times2)
-        if are_identical:
-            if trip_id1 == trip_id2:
-                identical_trips.append(trip_id1)
-            else:
-                changed_identical_trips.append((trip_id1, trip_id2))
-        else:
-            different_trips.append(trip_id1)
+    if trip_id_changes is None:
+        trip_id_changes = detect_trip_id_changes(feed1_trips, feed2_trips)
+
+    signatures1 = trip_signatures(feed1_stop_times)
+    signatures2 = trip_signatures(feed2_stop_times)
+
+    # Each feed1 trip is compared with the trip it is expected to be in feed2
+    trip_ids1 = feed1_trips['trip_id']
+    results = pd.DataFrame({
+        'trip_id_feed1': trip_ids1.to_numpy(),
+        'trip_id_feed2': trip_ids1.map(trip_id_changes).fillna(trip_ids1).to_numpy(),
+    })
+    signature1 = results['trip_id_feed1'].map(signatures1)
+    signature2 = results['trip_id_feed2'].map(signatures2)
+    identical = ((signature1 == signature2) | (signature1.isna() & signature2.isna())).fillna(False).to_numpy(dtype=bool)
+
+    # Otherwise the stop times may still be found unchanged under another feed2 trip_id
+    unique_signatures2 = signatures2[~signatures2.duplicated(keep=False)]
+    trip_by_signature2 = pd.Series(unique_signatures2.index, index=unique_signatures2.to_numpy())
+    found = signature1.map(trip_by_signature2)
+    claimed = set(results.loc[identical, 'trip_id_feed2'])
+    found = found.where(~identical & found.notna() & ~found.isin(claimed))
+    found = found.where(~found.duplicated() | found.isna())
+    relinked = found.notna().to_numpy()
+    results.loc[relinked, 'trip_id_feed2'] = found[relinked].to_numpy()
+
+    same_id = (results['trip_id_feed1'] == results['trip_id_feed2']).to_numpy()
+    results['status'] = np.select(
+        [identical & same_id, identical | relinked],
+        ['identical', 'renamed'],
+        default='different')
 
     print("\nComparison Results:")
-    print("Identical trips:")
-    for trip in identical_trips:
-        print(f"Trip with trip_id '{trip}' is identical in both feeds.")
-
-    print("\nTrips with trip_id changes:")
-    for old_id, new_id in changed_identical_trips:
-        print(f"Trip with trip_id '{old_id}' in Feed 1 is identical to '{new_id}' in Feed 2.")
+    counts = results['status'].value_counts()
+    for status in ['identical', 'renamed', 'different']:
+        print(f" - {status.capitalize()} trips: {counts.get(status, 0)}")
 
-    print("\nActually different trips:")
-    for trip in different_trips:
-        print(f"Trip with trip_id '{trip}' in Feed 1 is different.")
-
-    return identical_trips, changed_identical_trips, different_trips
+    return results
 
 # -------------------------------------------
 # Main Execution Logic
 # -------------------------------------------
 
-stop_times_list, trips_list, stops_list, calendar_dates_list, calendars_list, agency_list, routes_list, shapes_list = [], [], [], [], [], [], [], []
-for folder in input_folders:
-    stop_times, trips, stops, calD, cal, agency, routes, shapes = load_data(folder)
-    stop_times_list.append(stop_times)
-    trips_list.append(trips)
-    stops_list.append(stops)
-    calendar_dates_list.append(calD)
-    calendars_list.append(cal)
-    agency_list.append(agency)
-    routes_list.append(routes)
-    shapes_list.append(shapes)
-
-service_id_changes = detect_service_id_changes(calendars_list[0], calendars_list[1])
-for i in range(len(calendar_dates_list)):
-    calendar_dates_list[i] = update_service_ids_in_calendar_dates(calendar_dates_list[i], service_id_changes)
-
-trip_id_changes = detect_trip_id_changes(trips_list[0], trips_list[1])
-stop_id_changes = detect_stop_id_changes(stops_list[0], stops_list[1])
-route_id_changes = detect_route_id_changes(routes_list[0], routes_list[1])
-shape_id_changes = detect_shape_id_changes(shapes_list[0], shapes_list[1])
-
-stop_times_list[1] = update_stop_times_ids(stop_times_list[1], trip_id_changes, stop_id_changes)
-trips_list[1] = update_shape_ids_in_trips(trips_list[1], shape_id_changes)
-
-# Perform trips verification process
-identical_trips, changed_identical_trips, different_trips = verify_trips(
-    stop_times_list[0], stop_times_list[1], trips_list[0], trips_list[1]
-)
-
-# Ask user whether to proceed with the rest of the code
-proceed = input("\nVerification complete. Do you want to proceed with the rest of the process? (yes/no): ").strip().lower()
-if proceed != "yes":
-    print("Process terminated by user.")
-else:
-    # Update trips, routes, etc., and save to output
-    for i in range(len(trips_list)):
-        trips_list[i] = update_service_ids_in_trips(trips_list[i], service_id_changes)
-        trips_list[i] = update_route_ids_in_trips(trips_list[i], route_id_changes)
-
-    output_folder = ''
-    calendar_dates_list[1].to_csv(os.path.join(output_folder, 'calendar_dates.txt'), index=False)
-    calendars_list[1].to_csv(os.path.join(output_folder, 'calendar.txt'), index=False)
-    stops_list[1].to_csv(os.path.join(output_folder, 'stops.txt'), index=False)
-    trips_list[1].to_csv(os.path.join(output_folder, 'trips.txt'), index=False)
-    stop_times_list[1].to_csv(os.path.join(output_folder, 'stop_times.txt'), index=False)
-    routes_list[1].to_csv(os.path.join(output_folder, 'routes.txt'), index=False)
-    shapes_list[1].to_csv(os.path.join(output_folder, 'shapes.txt'), index=False)
-    agency_list[1].to_csv(os.path.join(output_folder, 'agency.txt'), index=False)
-    print("Updated files saved in specified output folder.")
+if __name__ == "__main__":
+    configure_feed_cache(feed_cache_folder, feed_cache_max_mb)
+    if metrics_path:
+        start_metrics('flow_update', profile_stages, profile_folder)
+
+    stop_times_list, trips_list, stops_list, calendar_dates_list, calendars_list, agency_list, routes_list, shapes_list = [], [], [], [], [], [], [], []
+    for folder in input_folders:
+        stop_times, trips, stops, calD, cal, agency, routes, shapes = load_data(folder)
+        stop_times_list.append(stop_times)
+        trips_list.append(trips)
+        stops_list.append(stops)
+        calendar_dates_list.append(calD)
+        calendars_list.append(cal)
+        agency_list.append(agency)
+        routes_list.append(routes)
+        shapes_list.append(shapes)
+
+    if mapping_store_path:
+        with closing(open_mapping_store(mapping_store_path)) as mapping_store:
+            service_id_changes, trip_id_changes, stop_id_changes, route_id_changes, shape_id_changes = \
+                detect_id_changes_with_store(mapping_store, calendars_list, calendar_dates_list, trips_list,
+                                             stop_times_list, stops_list, routes_list, shapes_list,
+                                             break_trip_ties_by_stop_pattern, stop_tolerance_m,
+                                             shape_precision, shape_tolerance_m)
+    else:
+        service_id_changes = detect_service_id_changes(calendars_list[0], calendars_list[1],
+                                                       calendar_dates_list[0], calendar_dates_list[1])
+        if break_trip_ties_by_stop_pattern:
+            trip_id_changes = detect_trip_id_changes(trips_list[0], trips_list[1], stop_times_list[0], stop_times_list[1])
+        else:
+            trip_id_changes = detect_trip_id_changes(trips_list[0], trips_list[1])
+        stop_id_changes = detect_stop_id_changes(stops_list[0], stops_list[1], stop_tolerance_m)
+        route_id_changes = detect_route_id_changes(routes_list[0], routes_list[1])
+        shape_id_changes = detect_shape_id_changes(shapes_list[0], shapes_list[1], shape_precision, shape_tolerance_m)
+
+    # Every mapping is applied to every referencing column of the second feed in one pass
+    feed2_tables = dict(zip(FEED_TABLES, [stop_times_list[1], trips_list[1], stops_list[1], calendar_dates_list[1],
+                                          calendars_list[1], agency_list[1], routes_list[1], shapes_list[1]]))
+    feed2_tables.update(load_referencing_tables(input_folders[1]))
+    rewritten = remap_feed(feed2_tables, {
+        'service': service_id_changes,
+        'trip': trip_id_changes,
+        'stop': stop_id_changes,
+        'route': route_id_changes,
+        'shape': shape_id_changes,
+    })
+    print("\nReferences rewritten:")
+    if not rewritten:
+        print(" - none")
+    for file_name, columns in rewritten.items():
+        for col, count in columns.items():
+            print(f" - {file_name} {col}: {count}")
+
+    # Perform trips verification process
+    trip_verification = verify_trips(
+        stop_times_list[0], feed2_tables['stop_times.txt'], trips_list[0], feed2_tables['trips.txt'], trip_id_changes
+    )
+
+    # Ask user whether to proceed with the rest of the code
+    proceed = input("\nVerification complete. Do you want to proceed with the rest of the process? (yes/no): ").strip().lower()
+    if proceed != "yes":
+        print("Process terminated by user.")
+    else:
+        output_folder = ''
+        for file_name, df in feed2_tables.items():
+            if df is None:
+                continue
+            write_gtfs_table(df, os.path.join(output_folder, file_name))
+        print("Updated files saved in specified output folder.")
+
+    if metrics_path:
+        stop_metrics().write(metrics_path)
+        print(f"Stage metrics saved to {metrics_path}")
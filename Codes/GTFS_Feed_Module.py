@@ -0,0 +1,520 @@
+"""
+This script provides shared access to GTFS feeds stored as folders or as .zip archives,
+along with helpers used by several modules.
+"""
+
+import io
+import os
+import zlib
+import codecs
+import hashlib
+import zipfile
+import importlib.util
+import numpy as np
+import pandas as pd
+from Stage_Metrics_Module import stage
+
+# pyarrow is optional, it only provides a faster CSV parser
+PARSER_ENGINE = 'pyarrow' if importlib.util.find_spec('pyarrow') else 'c'
+
+# Errors raised by the parsers when a file is not valid UTF-8, pyarrow's are reported the same way
+DECODE_ERRORS = (UnicodeDecodeError,)
+if PARSER_ENGINE == 'pyarrow':
+    import pyarrow
+    import pyarrow.ipc
+
+# -------------------------------------------
+# Feed sources (folder or .zip archive)
+# -------------------------------------------
+
+def is_zip_feed(source):
+    return str(source).lower().endswith('.zip') and os.path.isfile(source)
+
+def _zip_members(zip_file):
+
+    # Feeds are sometimes zipped with an enclosing folder, members are listed by file name
+    members = {}
+    for info in zip_file.infolist():
+        if not info.is_dir():
+            members.setdefault(os.path.basename(info.filename), info)
+    return members
+
+def list_feed_files(source):
+    if is_zip_feed(source):
+        with zipfile.ZipFile(source) as zip_file:
+            return list(_zip_members(zip_file))
+    return [f for f in os.listdir(source) if os.path.isfile(os.path.join(source, f))]
+
+def feed_file_exists(source, file_name):
+    if is_zip_feed(source):
+        return file_name in list_feed_files(source)
+    return os.path.isfile(os.path.join(source, file_name))
+
+def feed_file_info(source, file_name):
+
+    # For archives the size and CRC32 come from the central directory, nothing is decompressed
+    if is_zip_feed(source):
+        with zipfile.ZipFile(source) as zip_file:
+            info = _zip_members(zip_file)[file_name]
+        return {"size": info.file_size, "crc32": info.CRC}
+    stat = os.stat(os.path.join(source, file_name))
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def open_feed_file(source, file_name):
+
+    # Binary stream; archive members are decompressed on the fly while being read
+    if is_zip_feed(source):
+        with zipfile.ZipFile(source) as zip_file:
+            return zip_file.open(_zip_members(zip_file)[file_name])
+    return open(os.path.join(source, file_name), 'rb')
+
+# -------------------------------------------
+# Reading files with encoding fallback
+# -------------------------------------------
+
+def read_feed_bytes(source, file_name):
+    with open_feed_file(source, file_name) as f:
+        return f.read()
+
+def feed_file_encoding(source, file_name, block_size=1 << 20):
+
+    # Decodes the whole file once without keeping it, for readers that cannot restart
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open_feed_file(source, file_name) as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                decoder.decode(block)
+            decoder.decode(b'', final=True)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+def read_feed_header(source, file_name):
+    with open_feed_file(source, file_name) as f:
+        header = f.readline()
+    try:
+        header = header.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        header = header.decode('latin-1')
+    return parse_header(header)
+
+def parse_header(header):
+    return list(pd.read_csv(io.StringIO(header), dtype=str).columns)
+
+# -------------------------------------------
+# GTFS schema
+# -------------------------------------------
+
+# Column kinds: 'id' and 'category' are categorical text, 'time' is seconds
+# after midnight of the service day, 'date' is the YYYYMMDD integer
+ID, CATEGORY, TIME, DATE, TEXT = 'id', 'category', 'time', 'date', 'text'
+
+GTFS_SCHEMA = {
+    'agency.txt': {
+        'agency_id': ID, 'agency_name': TEXT, 'agency_url': TEXT, 'agency_timezone': CATEGORY,
+        'agency_lang': CATEGORY, 'agency_phone': TEXT, 'agency_fare_url': TEXT, 'agency_email': TEXT,
+    },
+    'stops.txt': {
+        'stop_id': ID, 'stop_code': TEXT, 'stop_name': TEXT, 'tts_stop_name': TEXT, 'stop_desc': TEXT,
+        'stop_lat': 'float64', 'stop_lon': 'float64', 'zone_id': ID, 'stop_url': TEXT,
+        'location_type': 'Int8', 'parent_station': ID, 'stop_timezone': CATEGORY,
+        'wheelchair_boarding': 'Int8', 'level_id': ID, 'platform_code': TEXT,
+    },
+    'routes.txt': {
+        'route_id': ID, 'agency_id': ID, 'route_short_name': TEXT, 'route_long_name': TEXT,
+        'route_desc': TEXT, 'route_type': 'Int16', 'route_url': TEXT, 'route_color': CATEGORY,
+        'route_text_color': CATEGORY, 'route_sort_order': 'Int32', 'continuous_pickup': 'Int8',
+        'continuous_drop_off': 'Int8', 'network_id': ID,
+    },
+    'trips.txt': {
+        'route_id': ID, 'service_id': ID, 'trip_id': ID, 'trip_headsign': CATEGORY,
+        'trip_short_name': TEXT, 'direction_id': 'Int8', 'block_id': ID, 'shape_id': ID,
+        'wheelchair_accessible': 'Int8', 'bikes_allowed': 'Int8',
+    },
+    'stop_times.txt': {
+        'trip_id': ID, 'arrival_time': TIME, 'departure_time': TIME, 'stop_id': ID,
+        'stop_sequence': 'Int32', 'stop_headsign': CATEGORY, 'pickup_type': 'Int8',
+        'drop_off_type': 'Int8', 'continuous_pickup': 'Int8', 'continuous_drop_off': 'Int8',
+        'shape_dist_traveled': 'float64', 'timepoint': 'Int8',
+    },
+    'calendar.txt': {
+        'service_id': ID, 'monday': 'Int8', 'tuesday': 'Int8', 'wednesday': 'Int8',
+        'thursday': 'Int8', 'friday': 'Int8', 'saturday': 'Int8', 'sunday': 'Int8',
+        'start_date': DATE, 'end_date': DATE,
+    },
+    'calendar_dates.txt': {'service_id': ID, 'date': DATE, 'exception_type': 'Int8'},
+    'shapes.txt': {
+        'shape_id': ID, 'shape_pt_lat': 'float64', 'shape_pt_lon': 'float64',
+        'shape_pt_sequence': 'Int32', 'shape_dist_traveled': 'float64',
+    },
+    'frequencies.txt': {
+        'trip_id': ID, 'start_time': TIME, 'end_time': TIME, 'headway_secs': 'Int32', 'exact_times': 'Int8',
+    },
+    'transfers.txt': {
+        'from_stop_id': ID, 'to_stop_id': ID, 'from_route_id': ID, 'to_route_id': ID,
+        'from_trip_id': ID, 'to_trip_id': ID, 'transfer_type': 'Int8', 'min_transfer_time': 'Int32',
+    },
+    'fare_attributes.txt': {
+        'fare_id': ID, 'price': 'float64', 'currency_type': CATEGORY, 'payment_method': 'Int8',
+        'transfers': 'Int8', 'agency_id': ID, 'transfer_duration': 'Int32',
+    },
+    'fare_rules.txt': {
+        'fare_id': ID, 'route_id': ID, 'origin_id': ID, 'destination_id': ID, 'contains_id': ID,
+    },
+    'feed_info.txt': {
+        'feed_publisher_name': TEXT, 'feed_publisher_url': TEXT, 'feed_lang': TEXT,
+        'default_lang': TEXT, 'feed_start_date': DATE, 'feed_end_date': DATE,
+        'feed_version': TEXT, 'feed_contact_email': TEXT, 'feed_contact_url': TEXT,
+    },
+    'pathways.txt': {
+        'pathway_id': ID, 'from_stop_id': ID, 'to_stop_id': ID, 'pathway_mode': 'Int8',
+        'is_bidirectional': 'Int8', 'length': 'float64', 'traversal_time': 'Int32',
+        'stair_count': 'Int32', 'max_slope': 'float64', 'min_width': 'float64',
+        'signposted_as': TEXT, 'reversed_signposted_as': TEXT,
+    },
+    'levels.txt': {'level_id': ID, 'level_index': 'float64', 'level_name': TEXT},
+}
+
+# Identifier columns of each file and the entity they identify or reference
+GTFS_FOREIGN_KEYS = {
+    'agency.txt': {'agency_id': 'agency'},
+    'stops.txt': {'stop_id': 'stop', 'parent_station': 'stop', 'zone_id': 'zone', 'level_id': 'level'},
+    'routes.txt': {'route_id': 'route', 'agency_id': 'agency', 'network_id': 'network'},
+    'trips.txt': {'route_id': 'route', 'service_id': 'service', 'trip_id': 'trip',
+                  'block_id': 'block', 'shape_id': 'shape'},
+    'stop_times.txt': {'trip_id': 'trip', 'stop_id': 'stop'},
+    'calendar.txt': {'service_id': 'service'},
+    'calendar_dates.txt': {'service_id': 'service'},
+    'shapes.txt': {'shape_id': 'shape'},
+    'frequencies.txt': {'trip_id': 'trip'},
+    'transfers.txt': {'from_stop_id': 'stop', 'to_stop_id': 'stop', 'from_route_id': 'route',
+                      'to_route_id': 'route', 'from_trip_id': 'trip', 'to_trip_id': 'trip'},
+    'fare_attributes.txt': {'fare_id': 'fare', 'agency_id': 'agency'},
+    'fare_rules.txt': {'fare_id': 'fare', 'route_id': 'route', 'origin_id': 'zone',
+                       'destination_id': 'zone', 'contains_id': 'zone'},
+    'pathways.txt': {'pathway_id': 'pathway', 'from_stop_id': 'stop', 'to_stop_id': 'stop'},
+    'levels.txt': {'level_id': 'level'},
+}
+
+def gtfs_column_kind(file_name, column):
+    return GTFS_SCHEMA.get(file_name, {}).get(column, TEXT)
+
+def _parser_dtypes(file_name, columns):
+    dtypes = {}
+    for col in columns:
+        kind = gtfs_column_kind(file_name, col)
+        if kind in (ID, CATEGORY, TIME):
+            dtypes[col] = 'category'
+        elif kind == DATE:
+            dtypes[col] = 'Int32'
+        elif kind == TEXT:
+            dtypes[col] = str
+        else:
+            dtypes[col] = kind
+    return dtypes
+
+def _read_csv_pyarrow(buffer, file_name, columns, as_text, encoding):
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+
+    # Every column type is given explicitly, letting pyarrow infer them would
+    # turn identifiers such as 0001 into integers
+    arrow_types = {'Int8': pa.int8(), 'Int16': pa.int16(), 'Int32': pa.int32(), DATE: pa.int32(),
+                   'float64': pa.float64(), TEXT: pa.string()}
+    column_types = {}
+    for col in columns:
+        kind = TEXT if as_text else gtfs_column_kind(file_name, col)
+        column_types[col] = arrow_types.get(kind) or pa.dictionary(pa.int32(), pa.string())
+
+    table = pa_csv.read_csv(
+        buffer,
+        read_options=pa_csv.ReadOptions(encoding='utf8' if encoding == 'utf-8-sig' else encoding),
+        # GTFS allows quoted fields spanning several lines, blocks must not be split inside them
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types, include_columns=columns,
+                                              strings_can_be_null=not as_text))
+    df = table.to_pandas()
+    if not as_text:
+        for col in columns:
+            kind = gtfs_column_kind(file_name, col)
+            if kind == DATE or kind.startswith('Int'):
+                df[col] = df[col].astype('Int32' if kind == DATE else kind)
+    return df
+
+def parse_gtfs_times(values):
+
+    # Only the distinct values are parsed, stop_times.txt repeats them heavily
+    values = values.astype('category')
+    if len(values.cat.categories) == 0:
+        # Blank column or chunk, e.g. non-timepoint stops left to interpolation
+        return pd.Series(pd.array([pd.NA] * len(values), dtype='Int32'), index=values.index, name=values.name)
+    parts = pd.Series(values.cat.categories.astype(str)).str.strip().str.split(':', expand=True)
+    if parts.shape[1] != 3:
+        raise ValueError(f"Unexpected time format in column {values.name}")
+    seconds = (parts[0].astype('int32') * 3600 + parts[1].astype('int32') * 60 + parts[2].astype('int32'))
+    codes = values.cat.codes.to_numpy()
+    result = pd.array(seconds.to_numpy(dtype='int32')[codes], dtype='Int32')
+    result[codes == -1] = pd.NA
+    return pd.Series(result, index=values.index, name=values.name)
+
+def format_gtfs_times(values):
+    codes, uniques = pd.factorize(values, use_na_sentinel=True)
+    text = np.array([f'{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}' for s in uniques.astype(int)] + [''],
+                    dtype=object)
+    return pd.Series(text[codes], index=values.index, name=values.name)
+
+def _apply_schema(df, file_name, as_text=False):
+    if as_text:
+        return df
+    for col in df.columns:
+        kind = gtfs_column_kind(file_name, col)
+        if kind == TIME:
+            df[col] = parse_gtfs_times(df[col])
+        elif kind in (ID, CATEGORY) and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    return df
+
+def parse_gtfs_csv(buffer, file_name, columns, usecols=None, engine=None, as_text=False, **kwargs):
+
+    # as_text keeps every value exactly as written, for comparisons. The pyarrow
+    # engine cannot read in chunks.
+    engine = engine or PARSER_ENGINE
+    if engine == 'pyarrow' and not kwargs.get('chunksize'):
+        start = buffer.tell()
+        encoding = kwargs.get('encoding', 'utf-8-sig')
+        try:
+            return _apply_schema(_read_csv_pyarrow(buffer, file_name, usecols or columns, as_text, encoding),
+                                 file_name, as_text)
+        except pyarrow.ArrowInvalid as error:
+            if 'invalid UTF8' in str(error):
+                raise UnicodeDecodeError(encoding, b'', 0, 0, str(error)) from error
+            # Values pyarrow will not convert to the column type, such as 0.0 in an Int8
+            # column, are left to the C engine, which reads the same files either way
+            buffer.seek(start)
+    if as_text:
+        return pd.read_csv(buffer, dtype=str, keep_default_na=False, usecols=usecols, **kwargs)
+    df = pd.read_csv(buffer, dtype=_parser_dtypes(file_name, usecols or columns), usecols=usecols, **kwargs)
+    if kwargs.get('chunksize'):
+        return (_apply_schema(chunk, file_name) for chunk in df)
+    return _apply_schema(df, file_name)
+
+def read_gtfs_table(source, file_name, usecols=None, engine=None, as_text=False):
+    with stage(f'read {file_name}') as record:
+        df = _read_gtfs_table(source, file_name, usecols, engine, as_text)
+        record['rows'] = len(df)
+    return df
+
+def _read_gtfs_table(source, file_name, usecols=None, engine=None, as_text=False):
+    columns = read_feed_header(source, file_name)
+    if usecols is not None:
+        usecols = [col for col in usecols if col in columns]
+
+    cache_path = feed_cache_path(source, file_name, usecols, as_text)
+    df = load_cached_table(cache_path) if cache_path else None
+    if df is not None:
+        return df
+
+    try:
+        with open_feed_file(source, file_name) as f:
+            df = parse_gtfs_csv(f, file_name, columns, usecols, engine, as_text, encoding='utf-8-sig')
+    except DECODE_ERRORS:
+        with open_feed_file(source, file_name) as f:
+            df = parse_gtfs_csv(f, file_name, columns, usecols, engine, as_text, encoding='latin-1')
+
+    if cache_path:
+        store_cached_table(cache_path, df)
+    return df
+
+def iter_gtfs_table(source, file_name, chunksize, usecols=None, as_text=False):
+    columns = read_feed_header(source, file_name)
+    if usecols is not None:
+        usecols = [col for col in usecols if col in columns]
+    encoding = feed_file_encoding(source, file_name)
+    with open_feed_file(source, file_name) as f:
+        yield from parse_gtfs_csv(f, file_name, columns, usecols, 'c', as_text,
+                                  encoding=encoding, chunksize=chunksize)
+
+def write_gtfs_table(df, path_or_buf, file_name=None, **kwargs):
+
+    # Times go back to HH:MM:SS, every other column is written as read
+    file_name = file_name or os.path.basename(str(path_or_buf))
+    time_columns = [col for col in df.columns
+                    if gtfs_column_kind(file_name, col) == TIME and pd.api.types.is_integer_dtype(df[col].dtype)]
+    with stage(f'write {file_name}') as record:
+        if time_columns:
+            df = df.assign(**{col: format_gtfs_times(df[col]) for col in time_columns})
+        df.to_csv(path_or_buf, index=False, **kwargs)
+        record['rows'] = len(df)
+
+# -------------------------------------------
+# On-disk cache of parsed tables
+# -------------------------------------------
+
+# The cache settings live in the environment so that worker processes share them
+FEED_CACHE_ENV = 'GTFSYNC_FEED_CACHE'
+FEED_CACHE_MAX_MB_ENV = 'GTFSYNC_FEED_CACHE_MAX_MB'
+FEED_CACHE_SUFFIX = '.arrow'
+
+# Bumped whenever the parsed form of a table changes, so older cache files are not reused
+FEED_CACHE_VERSION = 1
+
+def configure_feed_cache(folder, max_mb=2048):
+    if folder and PARSER_ENGINE != 'pyarrow':
+        print("The feed cache needs pyarrow, tables will be parsed on every run.")
+        folder = None
+    if folder:
+        os.environ[FEED_CACHE_ENV] = os.path.abspath(folder)
+        os.environ[FEED_CACHE_MAX_MB_ENV] = str(max_mb)
+    else:
+        os.environ.pop(FEED_CACHE_ENV, None)
+
+def source_file_key(source, file_name, block_size=1 << 20):
+
+    # Archives record the CRC32 of their members, loose files are checksummed
+    info = feed_file_info(source, file_name)
+    if "crc32" in info:
+        return f'{info["crc32"]:08x}{info["size"]:x}'
+    crc32 = 0
+    with open_feed_file(source, file_name) as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            crc32 = zlib.crc32(block, crc32)
+    return f'{crc32:08x}{info["size"]:x}'
+
+def feed_cache_path(source, file_name, usecols=None, as_text=False):
+    folder = os.environ.get(FEED_CACHE_ENV)
+    if not folder:
+        return None
+
+    # <source>.<file>.<variant>.<content key>.arrow, every part but the content key
+    # names the slot, so a changed source replaces its previous entry
+    source_tag = hashlib.sha1(os.path.abspath(source).encode('utf-8')).hexdigest()[:16]
+    variant = f'v{FEED_CACHE_VERSION}' + ('t' if as_text else 's')
+    if usecols is not None:
+        variant += hashlib.sha1(','.join(usecols).encode('utf-8')).hexdigest()[:8]
+    content_key = source_file_key(source, file_name)
+    return os.path.join(folder, f'{source_tag}.{file_name}.{variant}.{content_key}{FEED_CACHE_SUFFIX}')
+
+def load_cached_table(cache_path):
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with pyarrow.memory_map(cache_path) as f:
+            df = pyarrow.ipc.open_file(f).read_all().to_pandas()
+        # The modification time orders the entries for eviction
+        os.utime(cache_path)
+        return df
+    except (OSError, pyarrow.ArrowInvalid):
+        return None
+
+def store_cached_table(cache_path, df):
+    folder, name = os.path.split(cache_path)
+    slot = name.rsplit('.', 2)[0] + '.'
+    try:
+        os.makedirs(folder, exist_ok=True)
+        for old in os.listdir(folder):
+            if old.startswith(slot) and old != name:
+                os.remove(os.path.join(folder, old))
+
+        # Written under a temporary name, concurrent readers never see a partial file
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        temp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with pyarrow.OSFile(temp_path, 'wb') as f:
+            with pyarrow.ipc.new_file(f, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(temp_path, cache_path)
+    except (OSError, pyarrow.ArrowException):
+        return
+    evict_feed_cache(folder, float(os.environ.get(FEED_CACHE_MAX_MB_ENV, 2048)) * 1024 * 1024)
+
+def evict_feed_cache(folder, max_bytes):
+
+    # Least recently used entries go first
+    entries = []
+    for name in os.listdir(folder):
+        if name.endswith(FEED_CACHE_SUFFIX):
+            stat = os.stat(os.path.join(folder, name))
+            entries.append((stat.st_mtime_ns, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(folder, name))
+            total -= size
+        except OSError:
+            pass
+
+# -------------------------------------------
+# Identifier remapping
+# -------------------------------------------
+
+def remap_ids_counted(values, mapping):
+
+    # Distinct IDs are looked up once, rows follow through their codes. Categorical
+    # columns already carry the codes, other columns are factorized first
+    is_categorical = isinstance(values.dtype, pd.CategoricalDtype)
+    if not mapping:
+        return values, 0
+    if is_categorical:
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype=object)
+    mapped = uniques.map(mapping)
+    renamed = (mapped.notna() & (mapped != uniques)).to_numpy()
+    valid = codes >= 0
+    count = int(np.bincount(codes[valid], minlength=len(uniques))[renamed].sum())
+    if not count:
+        return values, 0
+
+    new_uniques = mapped.fillna(uniques)
+    if is_categorical:
+        category_codes, new_categories = pd.factorize(new_uniques)
+        new_codes = np.full(len(codes), -1, dtype=np.int64)
+        new_codes[valid] = category_codes[codes[valid]]
+        remapped = pd.Categorical.from_codes(new_codes, categories=new_categories)
+    else:
+        remapped = values.to_numpy(dtype=object, copy=True)
+        remapped[valid] = new_uniques.to_numpy()[codes[valid]]
+    return pd.Series(remapped, index=values.index, name=values.name), count
+
+def remap_ids(values, mapping):
+    return remap_ids_counted(values, mapping)[0]
+
+def remap_feed(tables, mappings):
+
+    # Every column referencing a remapped entity, in every file, following GTFS_FOREIGN_KEYS.
+    # tables maps file names to DataFrames updated in place, mappings maps entities to {old ID: new ID}
+    counts = {}
+    with stage('remap_feed') as record:
+        for file_name, df in tables.items():
+            if df is None:
+                continue
+            for col, entity in GTFS_FOREIGN_KEYS.get(file_name, {}).items():
+                if col in df.columns and mappings.get(entity):
+                    df[col], count = remap_ids_counted(df[col], mappings[entity])
+                    if count:
+                        counts.setdefault(file_name, {})[col] = count
+        record['rows'] = sum(sum(columns.values()) for columns in counts.values())
+    return counts
+
+# -------------------------------------------
+# Content signatures
+# -------------------------------------------
+
+def ordered_group_signatures(df, group_column, order_column, value_columns):
+
+    # One 64-bit hash per group of rows (a trip, a shape...) that depends on the
+    # values and on their order, but not on the group identifier itself
+    ordered = df.sort_values([group_column, order_column], kind='stable')
+    groups = ordered[group_column].to_numpy()
+    if len(groups) == 0:
+        return pd.Series(dtype='UInt64')
+
+    values = ordered[value_columns].astype(str)
+    values['_position'] = ordered.groupby(group_column, sort=False).cumcount().to_numpy()
+    row_hashes = pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+    # Nullable dtype, so that mapping IDs without a signature does not turn hashes into floats
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    return pd.Series(np.bitwise_xor.reduceat(row_hashes, starts), index=groups[starts], dtype='UInt64')
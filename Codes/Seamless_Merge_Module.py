@@ -4,9 +4,16 @@ This script compares applies suffixes to all unique identifiers and merges files
 
 import os
 import pandas as pd
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from GTFS_Feed_Module import (GTFS_FOREIGN_KEYS, feed_file_exists, read_feed_header, read_gtfs_table,
+                              iter_gtfs_table, write_gtfs_table, remap_ids, remap_feed,
+                              ordered_group_signatures, configure_feed_cache)
+from Stage_Metrics_Module import measured_stage, start_metrics, stop_metrics
 
 # -------------------------------------------
-# Define Input Folders
+# Define Input Folders (folders or .zip archives)
 # -------------------------------------------
 
 input_folders = [
@@ -17,19 +24,45 @@ input_folders = [
 # Corresponding suffixes for each feed (Ensure same number as input_folders)
 suffixes = ['Feed_1', 'Feed_2']
 
+# Write the merged files one feed at a time instead of holding every feed in memory
+streaming_merge = False
+
+# Rows per chunk in streaming mode (None = one whole file at a time)
+merge_chunksize = None
+
+# Feeds loaded and suffixed concurrently, bounds how many feeds are in memory (1 = one after another)
+max_workers = 1
+
+# Collapse stops, shapes and calendars published identically by several feeds (in-memory merge only)
+deduplicate_entities = False
+
+# Folder caching parsed tables between runs, needs pyarrow (None = off)
+feed_cache_folder = None
+
+# Size above which the least recently used cached tables are removed
+feed_cache_max_mb = 2048
+
+# File receiving per-stage timings and memory, Prometheus text for .prom, JSON otherwise (None = off)
+metrics_path = None
+
+# Stages profiled with cProfile ('*' = all), profiles are saved in profile_folder
+profile_stages = []
+profile_folder = ''
+
+gtfs_files = ['stop_times.txt', 'trips.txt', 'stops.txt', 
+              'calendar_dates.txt', 'calendar.txt', 'routes.txt', 
+              'agency.txt', 'shapes.txt']
+
 # ----------------------------------------------
 # Function to load data from a GTFS feed folder
 # ----------------------------------------------
 
+@measured_stage
 def load_gtfs_files(folder):
-    files = ['stop_times.txt', 'trips.txt', 'stops.txt', 
-             'calendar_dates.txt', 'calendar.txt', 'routes.txt', 
-             'agency.txt', 'shapes.txt']
     data = {}
-    for file in files:
-        path = os.path.join(folder, file)
-        if os.path.exists(path):
-            data[file] = pd.read_csv(path)
+    for file in gtfs_files:
+        if feed_file_exists(folder, file):
+            data[file] = read_gtfs_table(folder, file)
         else:
             print(f"File {file} not found in {folder}, skipping.")
     return data
@@ -38,26 +71,57 @@ def load_gtfs_files(folder):
 # Function to add suffixes to identifiers in a feed
 # --------------------------------------------------
 
+def suffix_ids(values, suffix):
+    # Categorical columns only rename their categories, each distinct ID is handled once
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.rename_categories(values.cat.categories.astype(str) + f"_{suffix}")
+    return values.where(values.isna(), values.astype(str) + f"_{suffix}")
+
+@measured_stage
 def add_suffix_to_feed(feed_data, suffix):
     updated_feed = {}
     for file_name, df in feed_data.items():
         df = df.copy()  # Avoid modifying the original DataFrame
-        for col in df.columns:
-            if col in ['direction_id']:
-                continue
-            if '_id' in col:
-                df[col] = df[col].apply(lambda x: f"{x}_{suffix}" if pd.notnull(x) else x)
+        for col in GTFS_FOREIGN_KEYS.get(file_name, {}):
+            if col in df.columns:
+                df[col] = suffix_ids(df[col], suffix)
         updated_feed[file_name] = df
     return updated_feed
 
+# --------------------------------------------------
+# Function to load and suffix several feeds, in parallel if requested
+# --------------------------------------------------
+
+def load_and_suffix_feed(folder, suffix):
+    print(f"\nLoading GTFS data from: {folder}")
+    feed_data = load_gtfs_files(folder)
+
+    print(f"Applying suffix '{suffix}' to feed data")
+    return add_suffix_to_feed(feed_data, suffix)
+
+def iter_suffixed_feeds(folders, suffixes, workers=1):
+    # Feeds come back in input order. At most `workers` feeds are being
+    # loaded or waiting to be consumed at any time.
+    if workers <= 1:
+        for folder, suffix in zip(folders, suffixes):
+            yield load_and_suffix_feed(folder, suffix)
+        return
+
+    jobs = iter(zip(folders, suffixes))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque(executor.submit(load_and_suffix_feed, *job) for job in islice(jobs, workers))
+        while pending:
+            feed_data = pending.popleft().result()
+            pending.extend(executor.submit(load_and_suffix_feed, *job) for job in islice(jobs, 1))
+            yield feed_data
+
 # --------------------------------------------------
 # Function to merge multiple feeds
 # --------------------------------------------------
 
-def merge_feeds(feed_data_list):
-    merged_data = {file: [] for file in ['stop_times.txt', 'trips.txt', 'stops.txt', 
-                                         'calendar_dates.txt', 'calendar.txt', 
-                                         'routes.txt', 'agency.txt', 'shapes.txt']}
+@measured_stage
+def merge_feeds(feed_data_list, deduplicate=False):
+    merged_data = {file: [] for file in gtfs_files}
 
     for feed_data in feed_data_list:
         for file_name, df in feed_data.items():
@@ -68,29 +132,165 @@ def merge_feeds(feed_data_list):
         if dataframes:  # Only merge if data is available for the file
             merged_result[file_name] = pd.concat(dataframes, ignore_index=True)
 
+    if deduplicate:
+        merged_result, report = deduplicate_merged_feed(merged_result)
+        print_deduplication_report(report)
+
     return merged_result
 
 # --------------------------------------------------
-# Main Execution
+# Function to collapse identical entities across feeds
 # --------------------------------------------------
 
-if __name__ == "__main__":
-    if len(input_folders) != len(suffixes):
-        raise ValueError("The number of feed folders and suffixes must match.")
+# Files holding the definition of each deduplicated entity, and its ID column
+DEDUPLICATED_ENTITIES = {
+    'stop': {'stops.txt': 'stop_id'},
+    'shape': {'shapes.txt': 'shape_id'},
+    'service': {'calendar.txt': 'service_id', 'calendar_dates.txt': 'service_id'},
+}
 
-    suffixed_feeds = []
+def _canonical_ids(ids, content_hashes):
+    # Every ID points to the first ID with the same content
+    ids = pd.Series(ids, dtype=object)
+    canonical = ids.groupby(pd.Series(content_hashes).to_numpy()).transform('first')
+    changed = (ids != canonical).to_numpy()
+    return dict(zip(ids[changed], canonical[changed]))
 
-    for folder, suffix in zip(input_folders, suffixes):
-        print(f"\nLoading GTFS data from: {folder}")
-        feed_data = load_gtfs_files(folder)
+def _row_hashes(df, exclude):
+    return pd.util.hash_pandas_object(df[[col for col in df.columns if col != exclude]], index=False).to_numpy()
 
-        print(f"Applying suffix '{suffix}' to feed data")
-        suffixed_feed_data = add_suffix_to_feed(feed_data, suffix)
+def _stop_mapping(stops):
+    # Children can only match once their parent stations have been collapsed
+    mapping = {}
+    while True:
+        stops = stops.assign(parent_station=remap_ids(stops['parent_station'], mapping)) \
+            if 'parent_station' in stops.columns else stops
+        new_mapping = _canonical_ids(stops['stop_id'], _row_hashes(stops, 'stop_id'))
+        if new_mapping == mapping:
+            return mapping
+        mapping = new_mapping
 
-        suffixed_feeds.append(suffixed_feed_data)
+def _shape_mapping(shapes):
+    columns = [col for col in ['shape_pt_lat', 'shape_pt_lon', 'shape_dist_traveled'] if col in shapes.columns]
+    signatures = ordered_group_signatures(shapes, 'shape_id', 'shape_pt_sequence', columns)
+    return _canonical_ids(signatures.index, signatures.to_numpy())
 
-    print("\nMerging feeds...")
-    merged_data = merge_feeds(suffixed_feeds)
+def _service_mapping(calendar, calendar_dates):
+    # A service is its weekly pattern plus its full set of exceptions
+    parts = []
+    if calendar is not None:
+        parts.append(pd.Series(_row_hashes(calendar, 'service_id'), index=calendar['service_id'].to_numpy(),
+                               name='calendar'))
+    if calendar_dates is not None:
+        parts.append(ordered_group_signatures(calendar_dates, 'service_id', 'date', ['date', 'exception_type'])
+                     .rename('calendar_dates'))
+    if not parts:
+        return {}
+    services = pd.concat(parts, axis=1).astype(str)
+    return _canonical_ids(services.index, pd.util.hash_pandas_object(services, index=False).to_numpy())
+
+@measured_stage
+def deduplicate_merged_feed(merged_data):
+    mappings = {}
+    if 'stops.txt' in merged_data:
+        mappings['stop'] = _stop_mapping(merged_data['stops.txt'])
+    if 'shapes.txt' in merged_data:
+        mappings['shape'] = _shape_mapping(merged_data['shapes.txt'])
+    if 'calendar.txt' in merged_data or 'calendar_dates.txt' in merged_data:
+        mappings['service'] = _service_mapping(merged_data.get('calendar.txt'), merged_data.get('calendar_dates.txt'))
+
+    report = {}
+    deduplicated = {}
+    for file_name, df in merged_data.items():
+        # Definitions of the collapsed IDs are dropped
+        drop = pd.Series(False, index=df.index)
+        for entity, files in DEDUPLICATED_ENTITIES.items():
+            if file_name in files and mappings.get(entity):
+                drop |= df[files[file_name]].isin(list(mappings[entity].keys()))
+        if drop.any():
+            dropped = df[drop]
+            report[file_name] = {
+                "rows": len(dropped),
+                "bytes": len(dropped.to_csv(index=False, header=False).encode('utf-8')),
+            }
+            df = df[~drop]
+        deduplicated[file_name] = df.reset_index(drop=True)
+
+    # Every reference to them is rewritten
+    remap_feed(deduplicated, mappings)
+    report["entities"] = {entity: len(mapping) for entity, mapping in mappings.items()}
+    return deduplicated, report
+
+def print_deduplication_report(report):
+    print("\nDeduplication:")
+    for entity, count in report["entities"].items():
+        print(f" - {entity}: {count} duplicate IDs collapsed")
+    for file_name, saved in report.items():
+        if file_name != "entities":
+            print(f" - {file_name}: {saved['rows']} rows and {saved['bytes']} bytes saved")
+
+# --------------------------------------------------
+# Function to merge feeds one at a time into the output files
+# --------------------------------------------------
+
+def unified_headers(folders):
+    # Union of the columns of every feed, in order of first appearance
+    headers = {}
+    for folder in folders:
+        for file in gtfs_files:
+            if feed_file_exists(folder, file):
+                columns = headers.setdefault(file, [])
+                columns.extend(col for col in read_feed_header(folder, file) if col not in columns)
+    return headers
+
+def iter_suffixed_tables(folder, suffix, chunksize=None):
+    for file in gtfs_files:
+        if not feed_file_exists(folder, file):
+            print(f"File {file} not found in {folder}, skipping.")
+            continue
+        chunks = iter_gtfs_table(folder, file, chunksize) if chunksize else [read_gtfs_table(folder, file)]
+        for chunk in chunks:
+            yield file, add_suffix_to_feed({file: chunk}, suffix)[file]
+
+def write_feeds_streaming(suffixed_tables, headers, output_folder):
+    # suffixed_tables yields one iterable of (file name, DataFrame) per feed
+    written = set()
+    for feed_tables in suffixed_tables:
+        for file_name, df in feed_tables:
+            output_path = os.path.join(output_folder, file_name)
+            first = file_name not in written
+            write_gtfs_table(df.reindex(columns=headers[file_name]), output_path,
+                             mode='w' if first else 'a', header=first)
+            written.add(file_name)
+    return written
+
+@measured_stage
+def merge_feeds_streaming(folders, suffixes, output_folder, chunksize=None, workers=1):
+    headers = unified_headers(folders)
+
+    def feeds():
+        # Parallel loading works on whole feeds, chunks only apply to sequential loading
+        if workers > 1:
+            for feed_data in iter_suffixed_feeds(folders, suffixes, workers):
+                yield feed_data.items()
+            return
+        for folder, suffix in zip(folders, suffixes):
+            print(f"\nLoading, suffixing ('{suffix}') and appending GTFS data from: {folder}")
+            yield iter_suffixed_tables(folder, suffix, chunksize)
+
+    for file_name in write_feeds_streaming(feeds(), headers, output_folder):
+        print(f"Merged {file_name} saved to {os.path.join(output_folder, file_name)}")
+
+# --------------------------------------------------
+# Main Execution
+# --------------------------------------------------
+
+if __name__ == "__main__":
+    if len(input_folders) != len(suffixes):
+        raise ValueError("The number of feed folders and suffixes must match.")
+    configure_feed_cache(feed_cache_folder, feed_cache_max_mb)
+    if metrics_path:
+        start_metrics('seamless_merge', profile_stages, profile_folder)
 
 # --------------------------------------------------
 # Define Output Folder
@@ -99,7 +299,21 @@ if __name__ == "__main__":
     output_folder = ''
     os.makedirs(output_folder, exist_ok=True)
 
-    for file_name, df in merged_data.items():
-        output_path = os.path.join(output_folder, file_name)
-        df.to_csv(output_path, index=False)
-        print(f"Merged {file_name} saved to {output_path}")
+    if streaming_merge:
+        if deduplicate_entities:
+            print("Deduplication needs every feed in memory, it is skipped in streaming mode.")
+        merge_feeds_streaming(input_folders, suffixes, output_folder, merge_chunksize, max_workers)
+    else:
+        suffixed_feeds = list(iter_suffixed_feeds(input_folders, suffixes, max_workers))
+
+        print("\nMerging feeds...")
+        merged_data = merge_feeds(suffixed_feeds, deduplicate_entities)
+
+        for file_name, df in merged_data.items():
+            output_path = os.path.join(output_folder, file_name)
+            write_gtfs_table(df, output_path)
+            print(f"Merged {file_name} saved to {output_path}")
+
+    if metrics_path:
+        stop_metrics().write(metrics_path)
+        print(f"Stage metrics saved to {metrics_path}")
@@ -0,0 +1,176 @@
+"""
+This script records wall time, CPU time, peak memory and row counts of the pipeline stages
+run by the other modules, and exports them as JSON or Prometheus text.
+"""
+
+import os
+import sys
+import json
+import time
+import cProfile
+import functools
+from contextlib import contextmanager
+import pandas as pd
+
+# resource only exists on Unix, peak memory is left out elsewhere
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# -------------------------------------------
+# Process memory
+# -------------------------------------------
+
+def peak_rss_mb():
+
+    # High-water mark of the resident set size since the process started
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return round(peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024, 3)
+
+def count_rows(result):
+    # Rows for tables, entries for mappings and summaries
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, dict):
+        if result and all(isinstance(value, pd.DataFrame) for value in result.values()):
+            return sum(len(value) for value in result.values())
+        return len(result)
+    if isinstance(result, tuple):
+        tables = [value for value in result if isinstance(value, pd.DataFrame)]
+        return sum(len(value) for value in tables) if tables else None
+    return None
+
+# -------------------------------------------
+# Stage recorder
+# -------------------------------------------
+
+class StageMetrics:
+
+    def __init__(self, module='', profile_stages=(), profile_folder=''):
+        self.module = module
+        self.records = []
+        # Stage names profiled with cProfile, '*' profiles every stage
+        self.profile_stages = set(profile_stages)
+        self.profile_folder = profile_folder
+        self._open = []
+        self._profiling = False
+
+    @contextmanager
+    def stage(self, name):
+        record = {
+            'stage': name,
+            'parent': self._open[-1]['stage'] if self._open else None,
+            'rows': None,
+        }
+        self._open.append(record)
+        # Only one profiler can run at a time, stages nested in a profiled stage are part of its profile
+        profiler = None
+        if (name in self.profile_stages or '*' in self.profile_stages) and not self._profiling:
+            profiler = cProfile.Profile()
+            self._profiling = True
+
+        peak_before = peak_rss_mb()
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler:
+                profiler.disable()
+                self._profiling = False
+            record['wall_s'] = round(time.perf_counter() - wall, 6)
+            record['cpu_s'] = round(time.process_time() - cpu, 6)
+            record['peak_rss_mb'] = peak_rss_mb()
+            record['peak_rss_growth_mb'] = (round(record['peak_rss_mb'] - peak_before, 3)
+                                            if peak_before is not None else None)
+            if profiler:
+                record['profile'] = self._dump_profile(profiler, name)
+            self._open.pop()
+            self.records.append(record)
+
+    def _dump_profile(self, profiler, name):
+        os.makedirs(self.profile_folder or '.', exist_ok=True)
+        safe_name = ''.join(c if c.isalnum() or c in '._-' else '_' for c in name)
+        path = os.path.join(self.profile_folder, f'{safe_name}.{len(self.records)}.prof')
+        profiler.dump_stats(path)
+        return path
+
+    # -------------------------------------------
+    # Export
+    # -------------------------------------------
+
+    def to_json(self):
+        return json.dumps({'module': self.module, 'stages': self.records}, indent=1)
+
+    def to_prometheus(self, prefix='gtfsync_stage'):
+        metrics = [
+            ('wall_s', 'wall_seconds', 'Wall-clock time of the stage in seconds'),
+            ('cpu_s', 'cpu_seconds', 'CPU time of the stage in seconds'),
+            ('peak_rss_mb', 'peak_rss_megabytes', 'Peak resident memory of the process after the stage'),
+            ('peak_rss_growth_mb', 'peak_rss_growth_megabytes',
+             'Increase of the peak resident memory during the stage'),
+            ('rows', 'rows', 'Rows or entries produced by the stage'),
+        ]
+        lines = []
+        for key, suffix, description in metrics:
+            lines.append(f'# HELP {prefix}_{suffix} {description}')
+            lines.append(f'# TYPE {prefix}_{suffix} gauge')
+            # Repeated stages (one per file, one per feed) are told apart by their occurrence
+            seen = {}
+            for record in self.records:
+                if record.get(key) is None:
+                    continue
+                occurrence = seen[record['stage']] = seen.get(record['stage'], -1) + 1
+                stage = record['stage'].replace('\\', '\\\\').replace('"', '\\"')
+                lines.append(f'{prefix}_{suffix}{{module="{self.module}",stage="{stage}",'
+                             f'occurrence="{occurrence}"}} {record[key]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # Prometheus text for .prom files, JSON otherwise
+        text = self.to_prometheus() if path.endswith('.prom') else self.to_json()
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+# -------------------------------------------
+# Active recorder used by the instrumented functions
+# -------------------------------------------
+
+_active = None
+
+def start_metrics(module='', profile_stages=(), profile_folder=''):
+    global _active
+    _active = StageMetrics(module, profile_stages, profile_folder)
+    return _active
+
+def stop_metrics():
+    global _active
+    metrics, _active = _active, None
+    return metrics
+
+@contextmanager
+def stage(name):
+    # Nothing is measured unless a recorder was started
+    if _active is None:
+        yield {}
+        return
+    with _active.stage(name) as record:
+        yield record
+
+def measured_stage(function):
+
+    # Records each call of the function as a stage named after it, with the rows it returns
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _active is None:
+            return function(*args, **kwargs)
+        with _active.stage(function.__name__) as record:
+            result = function(*args, **kwargs)
+            record['rows'] = count_rows(result)
+            return result
+    return wrapper
@@ -0,0 +1,220 @@
+"""
+This script generates synthetic GTFS feed pairs of controllable size and amount of change,
+used to benchmark the other modules.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from GTFS_Feed_Module import remap_feed, write_gtfs_table
+
+# -------------------------------------------
+# Define Feed Size and Changes
+# -------------------------------------------
+
+output_folder = ''
+
+# Number of routes, trips, stops, and points per shape of the first feed
+feed_size = {'routes': 20, 'trips': 2000, 'stops': 1000, 'shape_points': 200}
+
+# Share of entities renamed, trips added or removed, shapes moved, and how far they move in meters
+change_rates = {'rename': 0.05, 'add': 0.02, 'remove': 0.02, 'jitter': 0.1, 'jitter_m': 1.0}
+
+# Same seed, same feeds
+seed = 0
+
+# Stops visited by every trip of a route
+STOPS_PER_ROUTE = 20
+
+SERVICES = {
+    'WKDY': [1, 1, 1, 1, 1, 0, 0],
+    'SAT': [0, 0, 0, 0, 0, 1, 0],
+    'SUN': [0, 0, 0, 0, 0, 0, 1],
+}
+
+# -------------------------------------------
+# Function to generate a feed
+# -------------------------------------------
+
+def generate_feed(routes=20, trips=2000, stops=1000, shape_points=200, seed=0):
+    rng = np.random.default_rng(seed)
+
+    # Stops scattered over a 20 km square
+    stop_ids = np.array([f'S{i:06d}' for i in range(stops)], dtype=object)
+    stops_df = pd.DataFrame({
+        'stop_id': stop_ids,
+        'stop_name': [f'Stop {i}' for i in range(stops)],
+        'stop_lat': np.round(45.4 + rng.random(stops) * 0.18, 6),
+        'stop_lon': np.round(-73.7 + rng.random(stops) * 0.25, 6),
+        'stop_code': [f'{i:05d}' for i in range(stops)],
+    })
+
+    route_ids = np.array([f'R{i:04d}' for i in range(routes)], dtype=object)
+    routes_df = pd.DataFrame({
+        'route_id': route_ids,
+        'agency_id': 'A1',
+        'route_short_name': [str(i + 1) for i in range(routes)],
+        'route_long_name': [f'Route {i + 1}' for i in range(routes)],
+        'route_type': 3,
+    })
+
+    # Each route serves a fixed sequence of stops, at fixed running times
+    patterns = np.stack([rng.choice(stops, size=min(STOPS_PER_ROUTE, stops), replace=False) for _ in range(routes)])
+    running_times = np.cumsum(rng.integers(60, 240, size=patterns.shape), axis=1) - 60
+
+    # One shape per route, a random walk from its first stop
+    shape_ids = np.array([f'SH{i:04d}' for i in range(routes)], dtype=object)
+    start_lat = stops_df['stop_lat'].to_numpy()[patterns[:, 0]]
+    start_lon = stops_df['stop_lon'].to_numpy()[patterns[:, 0]]
+    steps = rng.normal(0, 0.0005, size=(routes, shape_points, 2)).cumsum(axis=1)
+    shapes_df = pd.DataFrame({
+        'shape_id': np.repeat(shape_ids, shape_points),
+        'shape_pt_lat': np.round((start_lat[:, None] + steps[:, :, 0]).ravel(), 6),
+        'shape_pt_lon': np.round((start_lon[:, None] + steps[:, :, 1]).ravel(), 6),
+        'shape_pt_sequence': np.tile(np.arange(1, shape_points + 1), routes),
+    })
+
+    calendar_df = pd.DataFrame(
+        [[service_id, *days, 20240101, 20241231] for service_id, days in SERVICES.items()],
+        columns=['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday',
+                 'start_date', 'end_date'])
+    calendar_dates_df = pd.DataFrame({
+        'service_id': ['WKDY', 'SUN', 'WKDY'],
+        'date': [20240101, 20240101, 20241225],
+        'exception_type': [2, 1, 2],
+    })
+
+    # Trips start between 05:00 and 25:00, past midnight as GTFS allows
+    trip_ids = np.array([f'T{i:07d}' for i in range(trips)], dtype=object)
+    trip_routes = rng.integers(0, routes, size=trips)
+    trips_df = pd.DataFrame({
+        'route_id': route_ids[trip_routes],
+        'service_id': rng.choice(list(SERVICES), size=trips),
+        'trip_id': trip_ids,
+        'direction_id': rng.integers(0, 2, size=trips),
+        'shape_id': shape_ids[trip_routes],
+    })
+    start_times = rng.integers(5 * 3600, 25 * 3600, size=trips) // 60 * 60
+
+    stops_per_trip = patterns.shape[1]
+    arrival = (start_times[:, None] + running_times[trip_routes]).ravel()
+    stop_times_df = pd.DataFrame({
+        'trip_id': np.repeat(trip_ids, stops_per_trip),
+        'arrival_time': format_times(arrival),
+        'departure_time': format_times(arrival + 30),
+        'stop_id': stop_ids[patterns[trip_routes].ravel()],
+        'stop_sequence': np.tile(np.arange(1, stops_per_trip + 1), trips),
+    })
+
+    agency_df = pd.DataFrame({
+        'agency_id': ['A1'],
+        'agency_name': ['Synthetic Transit'],
+        'agency_url': ['https://example.com'],
+        'agency_timezone': ['America/Montreal'],
+    })
+
+    return {
+        'agency.txt': agency_df,
+        'stops.txt': stops_df,
+        'routes.txt': routes_df,
+        'trips.txt': trips_df,
+        'stop_times.txt': stop_times_df,
+        'calendar.txt': calendar_df,
+        'calendar_dates.txt': calendar_dates_df,
+        'shapes.txt': shapes_df,
+    }
+
+def format_times(seconds):
+    seconds = np.asarray(seconds)
+    if seconds.size == 0:
+        return np.array([], dtype=object)
+    return pd.Series(seconds // 3600).map('{:02d}'.format).str.cat(
+        [pd.Series(seconds // 60 % 60).map('{:02d}'.format), pd.Series(seconds % 60).map('{:02d}'.format)],
+        sep=':').to_numpy(dtype=object)
+
+# -------------------------------------------
+# Function to derive a changed copy of a feed
+# -------------------------------------------
+
+def derive_changed_feed(feed, rename=0.05, add=0.02, remove=0.02, jitter=0.1, jitter_m=1.0, seed=1):
+    rng = np.random.default_rng(seed)
+    feed = {file_name: df.copy() for file_name, df in feed.items()}
+
+    # Renamed IDs keep their content, every reference follows
+    def renamed(ids, prefix):
+        ids = pd.unique(ids)
+        chosen = ids[rng.random(len(ids)) < rename]
+        return {old: f'{prefix}{old}' for old in chosen}
+
+    remap_feed(feed, {
+        'stop': renamed(feed['stops.txt']['stop_id'], 'N'),
+        'route': renamed(feed['routes.txt']['route_id'], 'N'),
+        'trip': renamed(feed['trips.txt']['trip_id'], 'N'),
+        'shape': renamed(feed['shapes.txt']['shape_id'], 'N'),
+        'service': renamed(feed['calendar.txt']['service_id'], 'N'),
+    })
+
+    # Removed trips disappear with their stop times
+    trips = feed['trips.txt']
+    removed = trips['trip_id'][rng.random(len(trips)) < remove]
+    feed['trips.txt'] = trips[~trips['trip_id'].isin(removed)].reset_index(drop=True)
+    stop_times = feed['stop_times.txt']
+    feed['stop_times.txt'] = stop_times[~stop_times['trip_id'].isin(removed)].reset_index(drop=True)
+
+    # Added trips copy an existing trip ten minutes later
+    trips = feed['trips.txt']
+    copied = trips[rng.random(len(trips)) < add]
+    new_ids = {old: f'X{i:07d}' for i, old in enumerate(copied['trip_id'])}
+    added_trips = copied.assign(trip_id=copied['trip_id'].map(new_ids))
+    stop_times = feed['stop_times.txt']
+    added_stop_times = stop_times[stop_times['trip_id'].isin(new_ids)]
+    added_stop_times = added_stop_times.assign(
+        trip_id=added_stop_times['trip_id'].map(new_ids),
+        arrival_time=format_times(parse_times(added_stop_times['arrival_time']) + 600),
+        departure_time=format_times(parse_times(added_stop_times['departure_time']) + 600))
+    feed['trips.txt'] = pd.concat([trips, added_trips], ignore_index=True)
+    feed['stop_times.txt'] = pd.concat([stop_times, added_stop_times], ignore_index=True)
+
+    # Jittered shapes move every point by up to jitter_m meters
+    shapes = feed['shapes.txt']
+    shape_ids = pd.unique(shapes['shape_id'])
+    moved = shapes['shape_id'].isin(shape_ids[rng.random(len(shape_ids)) < jitter]).to_numpy()
+    offset = rng.uniform(-jitter_m, jitter_m, size=(moved.sum(), 2)) / np.sqrt(2)
+    lat = shapes['shape_pt_lat'].to_numpy(dtype=float).copy()
+    lon = shapes['shape_pt_lon'].to_numpy(dtype=float).copy()
+    lat[moved] += offset[:, 0] / 110574.0
+    lon[moved] += offset[:, 1] / (111320.0 * np.cos(np.radians(lat[moved])))
+    feed['shapes.txt'] = shapes.assign(shape_pt_lat=np.round(lat, 7), shape_pt_lon=np.round(lon, 7))
+
+    return feed
+
+def parse_times(values):
+    if len(values) == 0:
+        return np.array([], dtype=np.int64)
+    parts = pd.Series(values).astype(str).str.split(':', expand=True).astype(int)
+    return (parts[0] * 3600 + parts[1] * 60 + parts[2]).to_numpy()
+
+# -------------------------------------------
+# Function to write a feed pair
+# -------------------------------------------
+
+def write_feed(feed, folder):
+    os.makedirs(folder, exist_ok=True)
+    for file_name, df in feed.items():
+        write_gtfs_table(df, os.path.join(folder, file_name))
+
+def generate_feed_pair(folder, size=None, changes=None, seed=0):
+    feed1 = generate_feed(**(size or feed_size), seed=seed)
+    feed2 = derive_changed_feed(feed1, **(changes or change_rates), seed=seed + 1)
+    folder1, folder2 = os.path.join(folder, 'feed1'), os.path.join(folder, 'feed2')
+    write_feed(feed1, folder1)
+    write_feed(feed2, folder2)
+    return folder1, folder2
+
+# -------------------------------------------
+# Main Execution Logic
+# -------------------------------------------
+
+if __name__ == "__main__":
+    folder1, folder2 = generate_feed_pair(output_folder, feed_size, change_rates, seed)
+    print(f"Synthetic feeds saved to {folder1} and {folder2}")
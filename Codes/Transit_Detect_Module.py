@@ -2,13 +2,25 @@
 This script compares files in two GTFS feed folders and summarizes differences at various detail levels.
 """
 
+import io
 import os
+import csv
+import json
+import math
+import zlib
+import hashlib
+import tempfile
+import numpy as np
 import pandas as pd 
-from difflib import unified_diff
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from GTFS_Feed_Module import (is_zip_feed, list_feed_files, feed_file_info, open_feed_file, read_feed_bytes,
+                              read_feed_header, parse_header, parse_gtfs_csv, read_gtfs_table, iter_gtfs_table,
+                              configure_feed_cache)
+from Stage_Metrics_Module import stage, measured_stage, start_metrics, stop_metrics
 
 # -------------------------------------------
-# Define Input Folders
+# Define Input Folders (folders or .zip archives)
 # -------------------------------------------
 
 input_folders = [
@@ -16,118 +28,714 @@ input_folders = [
     ''
 ]
 
+# Number of worker processes comparing files concurrently (1 = sequential)
+max_workers = 1
+
+# Memory budget in MB for each streamed comparison (None = load whole files)
+memory_budget_mb = None
+
+# Files compared in chunks through on-disk buckets when a memory budget is set
+streaming_files = ['stop_times.txt', 'shapes.txt']
+
+# Ordered snapshots (oldest first) compared as a timeline instead of input_folders (empty = off)
+timeline_snapshots = []
+
+# Labels of those snapshots in the ledger, unique (empty = the shortest part of their paths that differs)
+timeline_labels = []
+
+# CSV file receiving the cumulative change ledger of the timeline, one row per changed entity
+timeline_ledger_path = 'change_ledger.csv'
+
+# Folder caching parsed tables between runs, needs pyarrow (None = off)
+feed_cache_folder = None
+
+# Size above which the least recently used cached tables are removed
+feed_cache_max_mb = 2048
+
+# File receiving per-stage timings and memory, Prometheus text for .prom, JSON otherwise (None = off)
+metrics_path = None
+
+# Stages profiled with cProfile ('*' = all), profiles are saved in profile_folder
+profile_stages = []
+profile_folder = ''
+
+# -------------------------------------------
+# Natural primary keys of the GTFS files
+# -------------------------------------------
+
+GTFS_PRIMARY_KEYS = {
+    'agency.txt': ['agency_id'],
+    'stops.txt': ['stop_id'],
+    'routes.txt': ['route_id'],
+    'trips.txt': ['trip_id'],
+    'stop_times.txt': ['trip_id', 'stop_sequence'],
+    'calendar.txt': ['service_id'],
+    'calendar_dates.txt': ['service_id', 'date'],
+    'fare_attributes.txt': ['fare_id'],
+    'fare_rules.txt': ['fare_id', 'route_id', 'origin_id', 'destination_id', 'contains_id'],
+    'shapes.txt': ['shape_id', 'shape_pt_sequence'],
+    'frequencies.txt': ['trip_id', 'start_time'],
+    'transfers.txt': ['from_stop_id', 'to_stop_id', 'from_trip_id', 'to_trip_id', 'from_route_id', 'to_route_id'],
+    'pathways.txt': ['pathway_id'],
+    'levels.txt': ['level_id'],
+    'attributions.txt': ['attribution_id'],
+}
+
 # -------------------------------------------
 # Function to resolve  file encoding issues
 # -------------------------------------------
 
-def read_file_with_fallback(file_path):
+def read_lines_with_fallback(source, file_name):
    
+    data = read_feed_bytes(source, file_name)
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.readlines()
+        text = data.decode('utf-8-sig')
     except UnicodeDecodeError:
-        with open(file_path, 'r', encoding='latin-1') as f:
-            return f.readlines()
-        
+        text = data.decode('latin-1')
+    # Only line breaks end a row, splitlines would also split on \x85 and other separators
+    lines = io.StringIO(text, newline=None).read().split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+# -------------------------------------------
+# Snapshot manifest with file and row digests
+# -------------------------------------------
+
+# The manifest and the row-hash folder sit next to the feed folder or archive, not inside it
+MANIFEST_SUFFIX = '.gtfsync.json'
+ROW_HASHES_SUFFIX = '.gtfsync'
+
+# Raised whenever rows are split or hashed differently, older row hashes are then ignored
+ROW_HASHES_VERSION = 2
+
+def manifest_path(folder):
+    return os.path.normpath(folder) + MANIFEST_SUFFIX
+
+def load_manifest(folder):
+    try:
+        with open(manifest_path(folder), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(folder, manifest):
+    try:
+        with open(manifest_path(folder), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    except OSError:
+        print(f"Could not write the manifest for {folder}, digests will be recomputed next time.")
+
+def file_digest(file_path, block_size=1 << 20):
+    digest, crc32 = hashlib.sha256(), 0
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+            crc32 = zlib.crc32(block, crc32)
+    return digest.hexdigest(), crc32
+
+@measured_stage
+def fingerprint_feed(source):
+
+    # Archives already record the size and CRC32 of every member
+    if is_zip_feed(source):
+        return {file: feed_file_info(source, file) for file in list_feed_files(source)}
+
+    # Files whose size and modification time are unchanged keep their recorded digest
+    manifest = load_manifest(source)
+    fingerprints = {}
+    for file in list_feed_files(source):
+        entry = manifest.get(file)
+        info = feed_file_info(source, file)
+        if not entry or "crc32" not in entry or any(entry.get(k) != v for k, v in info.items()):
+            sha256, crc32 = file_digest(os.path.join(source, file))
+            entry = dict(info, sha256=sha256, crc32=crc32)
+        fingerprints[file] = entry
+
+    if fingerprints != manifest:
+        save_manifest(source, fingerprints)
+    return fingerprints
+
+def same_content(entry1, entry2):
+    if entry1.get("sha256") and entry2.get("sha256"):
+        return entry1["sha256"] == entry2["sha256"]
+    return (entry1["size"], entry1["crc32"]) == (entry2["size"], entry2["crc32"])
+
+def content_id(entry):
+    return entry.get("sha256") or f'{entry["crc32"]:08x}{entry["size"]:x}'
+
+def row_hashes(source, file_name, digest, lines):
+
+    # Cached per file digest, so a snapshot is only hashed once
+    cache_folder = os.path.normpath(source) + ROW_HASHES_SUFFIX
+    cache_path = os.path.join(cache_folder, f'{file_name}.v{ROW_HASHES_VERSION}.{digest}.npy')
+    if digest and os.path.exists(cache_path):
+        try:
+            hashes = np.load(cache_path)
+        except (OSError, ValueError):
+            hashes = None
+        # One hash per row, anything else was not hashed from these rows
+        if hashes is not None and len(hashes) == len(lines):
+            return hashes
+
+    hashes = pd.util.hash_array(lines)
+    # Repeated identical rows are told apart by their occurrence number
+    occurrence = pd.Series(hashes).groupby(hashes).cumcount().to_numpy(dtype=np.uint64)
+    hashes = hashes + occurrence * np.uint64(0x9E3779B97F4A7C15)
+
+    if digest:
+        try:
+            os.makedirs(cache_folder, exist_ok=True)
+            for old in os.listdir(cache_folder):
+                if old.startswith(f'{file_name}.') and old.endswith('.npy'):
+                    os.remove(os.path.join(cache_folder, old))
+            np.save(cache_path, hashes)
+        except OSError:
+            pass
+    return hashes
+
+def read_changed_rows(file_name, source1, source2, digest1=None, digest2=None):
+
+    lines1 = read_lines_with_fallback(source1, file_name)
+    lines2 = read_lines_with_fallback(source2, file_name)
+    header1, rows1 = (lines1[0], np.asarray(lines1[1:], dtype=object)) if lines1 else ('', np.array([], dtype=object))
+    header2, rows2 = (lines2[0], np.asarray(lines2[1:], dtype=object)) if lines2 else ('', np.array([], dtype=object))
+    del lines1, lines2
+
+    # Rows present verbatim in both files are dropped before parsing. This is
+    # skipped when a quoted field spans several lines, as lines are not rows then.
+    def has_multiline_fields(rows):
+        return bool((pd.Series(rows, dtype=object).str.count('"') % 2).any()) if len(rows) else False
+
+    if header1 != header2 or has_multiline_fields(rows1) or has_multiline_fields(rows2):
+        # Whole tables are compared, they may come from the feed cache
+        del rows1, rows2
+        return read_gtfs_table(source1, file_name, as_text=True), read_gtfs_table(source2, file_name, as_text=True)
+
+    hashes1 = row_hashes(source1, file_name, digest1, rows1)
+    hashes2 = row_hashes(source2, file_name, digest2, rows2)
+    rows1 = rows1[~np.isin(hashes1, hashes2)]
+    rows2 = rows2[~np.isin(hashes2, hashes1)]
+
+    def parse(header, rows):
+        # pyarrow cannot infer the columns of a header-only CSV
+        if not len(rows):
+            return pd.DataFrame(columns=parse_header(header) if header else [], dtype=str)
+        text = '\n'.join([header, *rows]).encode('utf-8')
+        return parse_gtfs_csv(io.BytesIO(text), file_name, parse_header(header), as_text=True, encoding='utf-8')
+
+    return parse(header1, rows1), parse(header2, rows2)
+
 # -------------------------------------------
 # Function to compare files in two folders 
 # -------------------------------------------
 
-def compare_folders(folder1, folder2):
+def compare_file(file, source1, source2, memory_budget_mb=None, entry1=None, entry2=None):
+    with stage(f'compare {file}') as record:
+        changes = _compare_file(file, source1, source2, memory_budget_mb, entry1, entry2)
+        record['rows'] = len(changes.get("added", [])) + len(changes.get("removed", [])) \
+            + changes.get("modified_rows", 0)
+    return changes
+
+def _compare_file(file, source1, source2, memory_budget_mb=None, entry1=None, entry2=None):
+
+    if source1 and source2:
+        if entry1 and entry2 and same_content(entry1, entry2):
+            return {"status": "No Changes"}
+        if memory_budget_mb and file in streaming_files:
+            return summarize_file_changes_streaming(file, source1, source2, memory_budget_mb)
+        if file.endswith('.txt'):
+            digest1 = content_id(entry1) if entry1 else None
+            digest2 = content_id(entry2) if entry2 else None
+            return summarize_file_changes(file, source1, source2, digest1, digest2)
+        return {"status": "Modified"}
+    elif source1:
+        return {"status": "Removed"}
+    return {"status": "Added"}
+
+@measured_stage
+def compare_folders(folder1, folder2, workers=1, memory_budget_mb=None):
    
-    folder1_files = {f: os.path.join(folder1, f) for f in os.listdir(folder1)}
-    folder2_files = {f: os.path.join(folder2, f) for f in os.listdir(folder2)}
+    fingerprints1 = fingerprint_feed(folder1)
+    fingerprints2 = fingerprint_feed(folder2)
 
-    all_files = set(folder1_files.keys()).union(folder2_files.keys())
+    all_files = set(fingerprints1.keys()).union(fingerprints2.keys())
 
     changes_summary = {}
+    jobs = {}
     for file in all_files:
-        file1_path = folder1_files.get(file)
-        file2_path = folder2_files.get(file)
+        entry1, entry2 = fingerprints1.get(file), fingerprints2.get(file)
+        if entry1 and entry2 and same_content(entry1, entry2):
+            # Identical content, nothing to read or parse
+            changes_summary[file] = {"status": "No Changes"}
+        else:
+            changes_summary[file] = None
+            jobs[file] = (folder1 if entry1 else None, folder2 if entry2 else None,
+                          memory_budget_mb, entry1, entry2)
 
-        if file1_path and file2_path:
-            f1_lines = read_file_with_fallback(file1_path)
-            f2_lines = read_file_with_fallback(file2_path)
-            diff = list(unified_diff(f1_lines, f2_lines, lineterm=''))
+    if workers <= 1:
+        for file, job in jobs.items():
+            changes_summary[file] = compare_file(file, *job)
+        return changes_summary
 
-            if diff:  
-                changes_summary[file] = summarize_file_changes(diff, file1_path, file2_path)
-            else:
-                changes_summary[file] = {"status": "No Changes"}
-        elif file1_path:
-            changes_summary[file] = {"status": "Removed"}
-        elif file2_path:
-            changes_summary[file] = {"status": "Added"}
+    # Largest files first, so stop_times.txt and shapes.txt do not start last
+    def job_size(file):
+        return max(entry["size"] for entry in jobs[file][3:] if entry)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {file: executor.submit(compare_file, file, *jobs[file])
+                   for file in sorted(jobs, key=job_size, reverse=True)}
+        for file, future in futures.items():
+            changes_summary[file] = future.result()
 
     return changes_summary
 
+# -------------------------------------------
+# Key-based row diff
+# -------------------------------------------
+
+def resolve_key_columns(columns1, columns2, key_columns):
+
+    common_columns = [col for col in columns1 if col in columns2]
+    return common_columns, [col for col in key_columns if col in common_columns] or common_columns
+
+def diff_by_key(df1, df2, key_columns):
+
+    common_columns, key_columns = resolve_key_columns(df1.columns, df2.columns, key_columns)
+    value_columns = [col for col in common_columns if col not in key_columns]
+
+    # Rows sharing a key (invalid, but common in the wild) are paired in file order
+    left = df1[common_columns].assign(
+        _occurrence=df1.groupby(key_columns, sort=False).cumcount(), _row=range(len(df1)))
+    right = df2[common_columns].assign(
+        _occurrence=df2.groupby(key_columns, sort=False).cumcount(), _row=range(len(df2)))
+
+    merged = pd.merge(left, right, on=key_columns + ['_occurrence'], how='outer',
+                      suffixes=('_old', '_new'), indicator=True, sort=False)
+
+    removed = df1.iloc[merged.loc[merged['_merge'] == 'left_only', '_row_old'].astype(int)]
+    added = df2.iloc[merged.loc[merged['_merge'] == 'right_only', '_row_new'].astype(int)]
+
+    both = merged[merged['_merge'] == 'both']
+    change_mask = pd.DataFrame(
+        {col: both[f'{col}_old'].to_numpy() != both[f'{col}_new'].to_numpy() for col in value_columns},
+        index=both.index, dtype=bool)
+    modified_rows = change_mask.any(axis=1).to_numpy()
+
+    modified = both[modified_rows].drop(columns=['_merge', '_occurrence'])
+    change_mask = change_mask[modified_rows]
+
+    return {
+        "key_columns": key_columns,
+        "added": added,
+        "removed": removed,
+        "modified": modified,
+        "change_mask": change_mask,
+    }
+
+def _row_lines(df):
+
+    if df.empty:
+        return []
+    return df.to_csv(index=False, header=False, lineterminator='\n').split('\n')[:-1]
+
+def _key_labels(df, key_columns):
+
+    labels = df[key_columns[0]].astype(str)
+    for col in key_columns[1:]:
+        labels = labels + '/' + df[col].astype(str)
+    return labels
+
 # -------------------------------------------
 # Function to summarize changed
 # -------------------------------------------
 
-def summarize_file_changes(diff, file1_path, file2_path):
-    changes = {
+def _new_changes():
+    return {
         "added": [],
         "removed": [],
-        "context_blocks": 0,
+        "modified_rows": 0,
         "attribute_changes": defaultdict(list)
     }
 
-    for line in diff:
-        if line.startswith('@@'):
-            changes["context_blocks"] += 1
-        elif line.startswith('+') and not line.startswith('+++'):
-            changes["added"].append(line.strip())
-        elif line.startswith('-') and not line.startswith('---'):
-            changes["removed"].append(line.strip())
+def _add_diff_to_changes(changes, diff):
 
-    if file1_path.endswith('.txt') and file2_path.endswith('.txt'):
-        try:
-            # Read files forcing all columns to be strings
-            df1 = pd.read_csv(file1_path, dtype=str)
-            df2 = pd.read_csv(file2_path, dtype=str)
+    changes["added"].extend(_row_lines(diff["added"]))
+    changes["removed"].extend(_row_lines(diff["removed"]))
+    changes["modified_rows"] += len(diff["modified"])
+
+    modified, change_mask = diff["modified"], diff["change_mask"]
+    labels = _key_labels(modified, diff["key_columns"])
+    for col in change_mask.columns:
+        col_mask = change_mask[col].to_numpy()
+        if col_mask.any():
+            changes["attribute_changes"][col].extend(zip(
+                labels[col_mask], modified.loc[col_mask, f'{col}_old'], modified.loc[col_mask, f'{col}_new']))
+
+def summarize_file_changes(file_name, source1, source2, digest1=None, digest2=None):
+    changes = _new_changes()
+
+    try:
+        df1, df2 = read_changed_rows(file_name, source1, source2, digest1, digest2)
+        _add_diff_to_changes(changes, diff_by_key(df1, df2, GTFS_PRIMARY_KEYS.get(file_name, [])))
+
+    except Exception as e:
+        changes["error"] = f"Error comparing attributes: {str(e)}"
+
+    return changes
+
+def count_changes(changes):
+    # Mid-level counts of a full change summary
+    if changes.get("status"):
+        return {"status": changes["status"]}
+    counts = {
+        "added": len(changes["added"]),
+        "removed": len(changes["removed"]),
+        "modified_rows": changes["modified_rows"],
+        "attribute_changes": {attr: len(changes_list) for attr, changes_list in changes["attribute_changes"].items()},
+    }
+    if "error" in changes:
+        counts["error"] = changes["error"]
+    return counts
+
+def count_file_changes(file, source1, source2, memory_budget_mb=None, entry1=None, entry2=None):
+
+    # Same comparison as compare_file, without formatting lines or listing attribute changes
+    if not (source1 and source2 and file.endswith('.txt')) or (entry1 and entry2 and same_content(entry1, entry2)) \
+            or (memory_budget_mb and file in streaming_files):
+        return count_changes(compare_file(file, source1, source2, memory_budget_mb, entry1, entry2))
+
+    counts = {"added": 0, "removed": 0, "modified_rows": 0, "attribute_changes": {}}
+    try:
+        df1, df2 = read_changed_rows(file, source1, source2,
+                                     content_id(entry1) if entry1 else None, content_id(entry2) if entry2 else None)
+        diff = diff_by_key(df1, df2, GTFS_PRIMARY_KEYS.get(file, []))
+        counts["added"] = len(diff["added"])
+        counts["removed"] = len(diff["removed"])
+        counts["modified_rows"] = len(diff["modified"])
+        counts["attribute_changes"] = {col: int(n) for col, n in diff["change_mask"].sum().items() if n}
+    except Exception as e:
+        counts["error"] = f"Error comparing attributes: {str(e)}"
+    return counts
+
+# -------------------------------------------
+# Bounded-memory comparison through spill buckets
+# -------------------------------------------
+
+# Rough ratio between the in-memory size of a text DataFrame and its CSV size
+DATAFRAME_EXPANSION = 10
 
-            common_columns = set(df1.columns).intersection(df2.columns)
+def _average_row_bytes(source, file_name, sample_size=1 << 16):
+    with open_feed_file(source, file_name) as f:
+        sample = f.read(sample_size)
+    return max(1, len(sample) // max(1, sample.count(b'\n')))
 
-            for col in common_columns:
-                for idx, (val1, val2) in enumerate(zip(df1[col], df2[col])):
-                    val1_nan, val2_nan = pd.isna(val1), pd.isna(val2)
+def _spill_to_buckets(source, file_name, key_columns, bucket_paths, chunksize):
 
-                    # Only report if exactly one is nan, or both non-nan and different
-                    if (val1_nan != val2_nan) or (not val1_nan and not val2_nan and val1 != val2):
-                        changes["attribute_changes"][col].append((idx, val1, val2))
+    # Rows are routed by a hash of their key, so a key always lands in the same bucket in both files
+    for path in bucket_paths:
+        open(path, 'w').close()
+    for chunk in iter_gtfs_table(source, file_name, chunksize, as_text=True):
+        buckets = pd.util.hash_pandas_object(chunk[key_columns], index=False).to_numpy() % len(bucket_paths)
+        for bucket, part in chunk.groupby(buckets, sort=False):
+            part.to_csv(bucket_paths[bucket], mode='a', header=False, index=False, encoding='utf-8')
 
-        except Exception as e:
-            changes["error"] = f"Error comparing attributes: {str(e)}"
+def _read_bucket(path, columns):
+    if os.path.getsize(path) == 0:
+        return pd.DataFrame(columns=columns, dtype=str)
+    return pd.read_csv(path, dtype=str, keep_default_na=False, header=None, names=columns, encoding='utf-8')
+
+def summarize_file_changes_streaming(file_name, source1, source2, memory_budget_mb, spill_dir=None):
+    changes = _new_changes()
+
+    try:
+        columns1, columns2 = read_feed_header(source1, file_name), read_feed_header(source2, file_name)
+        _, key_columns = resolve_key_columns(
+            columns1, columns2, GTFS_PRIMARY_KEYS.get(file_name, []))
+
+        budget = memory_budget_mb * 1024 * 1024
+        total_size = feed_file_info(source1, file_name)["size"] + feed_file_info(source2, file_name)["size"]
+        bucket_count = max(1, math.ceil(total_size * DATAFRAME_EXPANSION / budget))
+        row_bytes = max(_average_row_bytes(source1, file_name), _average_row_bytes(source2, file_name))
+        chunksize = max(1000, budget // (4 * DATAFRAME_EXPANSION * row_bytes))
+
+        with tempfile.TemporaryDirectory(dir=spill_dir) as work_dir:
+            buckets1 = [os.path.join(work_dir, f'old_{i}.csv') for i in range(bucket_count)]
+            buckets2 = [os.path.join(work_dir, f'new_{i}.csv') for i in range(bucket_count)]
+            _spill_to_buckets(source1, file_name, key_columns, buckets1, chunksize)
+            _spill_to_buckets(source2, file_name, key_columns, buckets2, chunksize)
+
+            for bucket1, bucket2 in zip(buckets1, buckets2):
+                df1 = _read_bucket(bucket1, columns1)
+                df2 = _read_bucket(bucket2, columns2)
+                _add_diff_to_changes(changes, diff_by_key(df1, df2, key_columns))
+                os.remove(bucket1)
+                os.remove(bucket2)
+
+    except Exception as e:
+        changes["error"] = f"Error comparing attributes: {str(e)}"
 
     return changes
 
+# -------------------------------------------
+# Timeline of consecutive snapshots
+# -------------------------------------------
+
+LEDGER_COLUMNS = ['file', 'entity_id', 'snapshot', 'change', 'attributes']
+
+def snapshot_labels(snapshots):
+
+    # Shortest trailing part of the paths that tells the snapshots apart, so that
+    # .../2024-01-01/gtfs.zip and .../2024-01-08/gtfs.zip do not both become gtfs
+    parts = [os.path.normpath(os.path.abspath(source)).split(os.sep) for source in snapshots]
+    labels = []
+    for depth in range(1, max((len(p) for p in parts), default=0) + 1):
+        labels = ['/'.join(p[-depth:]) for p in parts]
+        if len(set(labels)) == len(labels):
+            return labels
+    # The same snapshot listed more than once
+    return [f'{position}:{label}' for position, label in enumerate(labels, 1)]
+
+def load_snapshot(source, fingerprints, previous=None, previous_fingerprints=None):
+
+    # Files unchanged since the previous snapshot are carried over instead of parsed again
+    tables = {}
+    for file, entry in fingerprints.items():
+        if not file.endswith('.txt'):
+            continue
+        previous_entry = (previous_fingerprints or {}).get(file)
+        if previous is not None and file in previous and previous_entry and same_content(previous_entry, entry):
+            tables[file] = previous[file]
+        else:
+            tables[file] = read_gtfs_table(source, file, as_text=True)
+    return tables
+
+def entity_changes(file_name, df1, df2, label):
+
+    # Row changes are folded into one event per entity ID: added, removed, or
+    # modified with the attributes that changed ('rows' when rows were added or removed)
+    diff = diff_by_key(df1, df2, GTFS_PRIMARY_KEYS.get(file_name, []))
+    id_column = diff["key_columns"][0]
+    modified, change_mask = diff["modified"], diff["change_mask"]
+    parts = [
+        pd.DataFrame({'entity_id': diff["added"][id_column].to_numpy(), 'attribute': 'rows'}),
+        pd.DataFrame({'entity_id': diff["removed"][id_column].to_numpy(), 'attribute': 'rows'}),
+    ]
+    for col in change_mask.columns:
+        col_mask = change_mask[col].to_numpy()
+        if col_mask.any():
+            parts.append(pd.DataFrame({'entity_id': modified.loc[col_mask, id_column].to_numpy(), 'attribute': col}))
+    events = pd.concat(parts, ignore_index=True)
+    if events.empty:
+        return pd.DataFrame(columns=LEDGER_COLUMNS)
+
+    attributes = events.groupby('entity_id', sort=True)['attribute'].agg(lambda a: ','.join(sorted(set(a))))
+    ids = attributes.index
+    before = ids.isin(df1[id_column].unique()) if id_column in df1.columns else np.zeros(len(ids), dtype=bool)
+    after = ids.isin(df2[id_column].unique()) if id_column in df2.columns else np.zeros(len(ids), dtype=bool)
+    change = np.select([~before, ~after], ['added', 'removed'], default='modified')
+    return pd.DataFrame({
+        'file': file_name,
+        'entity_id': ids.to_numpy(),
+        'snapshot': label,
+        'change': change,
+        'attributes': np.where(change == 'modified', attributes.to_numpy(), ''),
+    })
+
+@measured_stage
+def compare_timeline(snapshots, labels=None):
+
+    labels = list(labels) if labels else snapshot_labels(snapshots)
+    if len(labels) != len(snapshots) or len(set(labels)) != len(labels):
+        raise ValueError("Each snapshot needs its own label")
+
+    # Each snapshot is parsed once, and only two parsed snapshots are held at a time
+    events = []
+    previous = previous_fingerprints = None
+    for source, label in zip(snapshots, labels):
+        fingerprints = fingerprint_feed(source)
+        current = load_snapshot(source, fingerprints, previous, previous_fingerprints)
+        if previous is not None:
+            changed = 0
+            for file in sorted(set(previous) | set(current)):
+                entry1, entry2 = previous_fingerprints.get(file), fingerprints.get(file)
+                if entry1 and entry2 and same_content(entry1, entry2):
+                    continue
+                # A missing file counts as an empty one, its entities are all added or removed
+                df1 = previous.get(file, pd.DataFrame(columns=current[file].columns if file in current else []))
+                df2 = current.get(file, pd.DataFrame(columns=df1.columns))
+                file_events = entity_changes(file, df1, df2, label)
+                changed += len(file_events)
+                events.append(file_events)
+            print(f"{label}: {changed} entity changes")
+        previous, previous_fingerprints = current, fingerprints
+
+    return pd.concat(events, ignore_index=True) if events else pd.DataFrame(columns=LEDGER_COLUMNS)
+
+def cumulative_ledger(events):
+
+    # One row per entity that ever changed, with its history in snapshot order
+    if events.empty:
+        return pd.DataFrame(columns=['file', 'entity_id', 'first_change', 'last_change', 'changes', 'history'])
+    entries = events['snapshot'] + ':' + events['change'] + np.where(
+        events['attributes'] != '', '[' + events['attributes'] + ']', '')
+    grouped = events.assign(entry=entries).groupby(['file', 'entity_id'], sort=True)
+    return pd.DataFrame({
+        'first_change': grouped['snapshot'].first(),
+        'last_change': grouped['snapshot'].last(),
+        'changes': grouped.size(),
+        'history': grouped['entry'].agg('; '.join),
+    }).reset_index()
+
+def save_change_ledger(events, output_file):
+    cumulative_ledger(events).to_csv(output_file, index=False)
+    print(f"Change ledger saved to {output_file}.")
+
+# -------------------------------------------
+# Lazy change summary
+# -------------------------------------------
+
+class LazyChangeSummary:
+
+    # Statuses come from the file fingerprints alone. Counts are computed the first
+    # time they are needed and kept, full details are computed on request and only
+    # the most recent ones are kept.
+    def __init__(self, folder1, folder2, workers=1, memory_budget_mb=None, detail_cache_size=4):
+        self.folder1, self.folder2 = folder1, folder2
+        self.workers = workers
+        self.memory_budget_mb = memory_budget_mb
+        self.detail_cache_size = detail_cache_size
+        self.fingerprints1 = fingerprint_feed(folder1)
+        self.fingerprints2 = fingerprint_feed(folder2)
+        self.files = sorted(set(self.fingerprints1) | set(self.fingerprints2))
+        self._counts = {}
+        self._details = OrderedDict()
+
+    def _job(self, file):
+        entry1, entry2 = self.fingerprints1.get(file), self.fingerprints2.get(file)
+        return (file, self.folder1 if entry1 else None, self.folder2 if entry2 else None,
+                self.memory_budget_mb, entry1, entry2)
+
+    def status(self, file):
+        entry1, entry2 = self.fingerprints1.get(file), self.fingerprints2.get(file)
+        if entry1 and entry2:
+            return "No Changes" if same_content(entry1, entry2) else "Modified"
+        return "Removed" if entry1 else "Added"
+
+    def counts(self, file):
+        if file not in self._counts:
+            if file in self._details:
+                self._counts[file] = count_changes(self._details[file])
+            else:
+                self._counts[file] = count_file_changes(*self._job(file))
+        return self._counts[file]
+
+    def details(self, file, cache=True):
+        if file in self._details:
+            self._details.move_to_end(file)
+            return self._details[file]
+        changes = compare_file(*self._job(file))
+        self._counts.setdefault(file, count_changes(changes))
+        if cache and self.detail_cache_size:
+            self._details[file] = changes
+            while len(self._details) > self.detail_cache_size:
+                self._details.popitem(last=False)
+        return changes
+
+    def _largest_first(self, files):
+        # As in compare_folders, stop_times.txt and shapes.txt should not start last
+        return sorted(files, key=lambda file: max(entry["size"] for entry in self._job(file)[4:] if entry),
+                      reverse=True)
+
+    def all_counts(self):
+        pending = [file for file in self.files if file not in self._counts and file not in self._details
+                   and self.status(file) == "Modified"]
+        if self.workers > 1 and len(pending) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = {file: executor.submit(count_file_changes, *self._job(file))
+                           for file in self._largest_first(pending)}
+                for file, future in futures.items():
+                    self._counts[file] = future.result()
+        return {file: self.counts(file) for file in self.files}
+
+    def iter_details(self):
+
+        # Details of every file, one at a time. With several workers, the largest files are
+        # compared first and only as many results as workers are held at once, so files
+        # come out in that order rather than by name.
+        modified = [file for file in self.files if self.status(file) == "Modified"]
+        if self.workers <= 1 or len(modified) < 2:
+            for file in self.files:
+                yield file, self.details(file, cache=False) if file in modified else {"status": self.status(file)}
+            return
+
+        for file in self.files:
+            if file not in modified:
+                yield file, {"status": self.status(file)}
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            queue = deque(self._largest_first(modified))
+            running = deque()
+            while queue or running:
+                while queue and len(running) < self.workers:
+                    file = queue.popleft()
+                    running.append((file, executor.submit(compare_file, *self._job(file))))
+                file, future = running.popleft()
+                changes = future.result()
+                self._counts.setdefault(file, count_changes(changes))
+                yield file, changes
+
+class ChangeSummary:
+
+    # The same interface over the dict returned by compare_folders, all of it already computed
+    def __init__(self, changes_summary):
+        self.changes_summary = changes_summary
+        self.files = list(changes_summary)
+
+    def status(self, file):
+        return self.changes_summary[file].get("status") or "Modified"
+
+    def counts(self, file):
+        return count_changes(self.changes_summary[file])
+
+    def all_counts(self):
+        return {file: self.counts(file) for file in self.files}
+
+    def details(self, file, cache=True):
+        return self.changes_summary[file]
+
+    def iter_details(self):
+        return iter(self.changes_summary.items())
+
+def as_change_summary(summary):
+    return ChangeSummary(summary) if isinstance(summary, dict) else summary
+
 # -------------------------------------------
 # Granularity level functions
 # -------------------------------------------
 
-def display_high_level_summary(changes_summary):
+def display_high_level_summary(summary):
    
+    summary = as_change_summary(summary)
     print("High-Level Summary:")
-    for file, changes in changes_summary.items():
-        status = changes.get("status", "Modified")
-        print(f" - {file}: {status}")
+    for file in summary.files:
+        print(f" - {file}: {summary.status(file)}")
 
-def display_mid_level_summary(changes_summary):
+def display_mid_level_summary(summary):
    
+    summary = as_change_summary(summary)
     print("Mid-Level Summary:")
-    for file, changes in changes_summary.items():
-        if changes.get("status"):
-            print(f"File: {file}")
-            print(f" - Status: {changes['status']}")
+    for file, counts in summary.all_counts().items():
+        print(f"File: {file}")
+        if counts.get("status"):
+            print(f" - Status: {counts['status']}")
         else:
-            print(f"File: {file}")
-            print(f" - Added Lines: {len(changes['added'])}")
-            print(f" - Removed Lines: {len(changes['removed'])}")
-            print(f" - Modified Sections: {changes['context_blocks']}")
-            if "attribute_changes" in changes:
-                for attr, changes_list in changes["attribute_changes"].items():
-                    print(f"   - Changes in {attr}: {len(changes_list)} changes")
+            print(f" - Added Lines: {counts['added']}")
+            print(f" - Removed Lines: {counts['removed']}")
+            print(f" - Modified Rows: {counts['modified_rows']}")
+            for attr, count in counts["attribute_changes"].items():
+                print(f"   - Changes in {attr}: {count} changes")
+            if counts.get("error"):
+                print(f" - {counts['error']}")
                     
 def display_detailed_changes(file_name, changes):
     
@@ -141,44 +749,74 @@ def display_detailed_changes(file_name, changes):
         print(f" - Removed Lines: {len(changes['removed'])}")
         for line in changes['removed']:
             print(f"   - {line}")
-        print(f" - Modified Sections: {changes['context_blocks']}")
+        print(f" - Modified Rows: {changes['modified_rows']}")
+        if changes.get("error"):
+            print(f" - {changes['error']}")
         if "attribute_changes" in changes:
             print(" - Attribute-Level Changes:")
             for attr, changes_list in changes["attribute_changes"].items():
                 print(f"   Attribute: {attr}")
-                for idx, old_val, new_val in changes_list:
-                    print(f"     Row {idx}: {old_val} → {new_val}")
+                for key, old_val, new_val in changes_list:
+                    print(f"     {key}: {old_val} → {new_val}")
 
 # -------------------------------------------
 # Save change log
 # -------------------------------------------
 
-def save_change_log(changes_summary, output_file):
-   
-    with open(output_file, 'w') as f:
-        f.write("Change Log\n")
-        for file, changes in changes_summary.items():
-            f.write(f"File: {file}\n")
-            if changes.get("status"):
-                f.write(f" - Status: {changes['status']}\n")
-            else:
+CHANGE_LOG_FIELDS = ['file', 'change', 'key', 'attribute', 'old', 'new']
+
+def iter_change_records(summary):
+
+    # One record per change, files come as iter_details hands them out
+    for file, changes in as_change_summary(summary).iter_details():
+        if changes.get("status") or changes.get("error"):
+            yield {'file': file, 'change': changes.get("status") or "Error", 'new': changes.get("error")}
+        for line in changes.get("added", []):
+            yield {'file': file, 'change': "Added", 'new': line}
+        for line in changes.get("removed", []):
+            yield {'file': file, 'change': "Removed", 'old': line}
+        for attr, changes_list in changes.get("attribute_changes", {}).items():
+            for key, old_val, new_val in changes_list:
+                yield {'file': file, 'change': "Modified", 'key': key, 'attribute': attr, 'old': old_val, 'new': new_val}
+
+def save_change_log(summary, output_file):
+
+    # .jsonl and .csv get one structured record per change, other names the text log
+    extension = os.path.splitext(output_file)[1].lower()
+    with open(output_file, 'w', encoding='utf-8', newline='' if extension == '.csv' else None) as f:
+        if extension == '.jsonl':
+            for record in iter_change_records(summary):
+                f.write(json.dumps(record, default=str, ensure_ascii=False) + "\n")
+        elif extension == '.csv':
+            writer = csv.DictWriter(f, fieldnames=CHANGE_LOG_FIELDS)
+            writer.writeheader()
+            writer.writerows(iter_change_records(summary))
+        else:
+            f.write("Change Log\n")
+            for file, changes in as_change_summary(summary).iter_details():
+                f.write(f"File: {file}\n")
+                if changes.get("status"):
+                    f.write(f" - Status: {changes['status']}\n")
+                    continue
                 f.write(f" - Added Lines: {len(changes['added'])}\n")
                 f.write(f" - Removed Lines: {len(changes['removed'])}\n")
-                f.write(f" - Modified Sections: {changes['context_blocks']}\n")
-                if "attribute_changes" in changes:
-                    f.write(" - Attribute-Level Changes:\n")
-                    for attr, changes_list in changes["attribute_changes"].items():
-                        f.write(f"   Attribute: {attr}\n")
-                        for idx, old_val, new_val in changes_list:
-                            f.write(f"     Row {idx}: {old_val} → {new_val}\n")
+                f.write(f" - Modified Rows: {changes['modified_rows']}\n")
+                if changes.get("error"):
+                    f.write(f" - {changes['error']}\n")
+                f.write(" - Attribute-Level Changes:\n")
+                for attr, changes_list in changes["attribute_changes"].items():
+                    f.write(f"   Attribute: {attr}\n")
+                    for key, old_val, new_val in changes_list:
+                        f.write(f"     {key}: {old_val} → {new_val}\n")
     print(f"Change log saved to {output_file}.")
 
 # -------------------------------------------
 # Interactive Menu
 # -------------------------------------------
 
-def interactive_menu(changes_summary):
+def interactive_menu(summary):
     
+    summary = as_change_summary(summary)
     print("Select granularity level:")
     print("1. High-Level Summary")
     print("2. Mid-Level Summary")
@@ -186,31 +824,42 @@ def interactive_menu(changes_summary):
     choice = input("Enter your choice (1/2/3): ").strip()
 
     if choice == '1':
-        display_high_level_summary(changes_summary)
+        display_high_level_summary(summary)
     elif choice == '2':
-        display_mid_level_summary(changes_summary)
+        display_mid_level_summary(summary)
     elif choice == '3':
-        for file, changes in changes_summary.items():
+        for file, changes in summary.iter_details():
             display_detailed_changes(file, changes)
     else:
         print("Invalid choice. Defaulting to high-level summary.")
-        display_high_level_summary(changes_summary)
+        display_high_level_summary(summary)
 
     further_choice = input("\nDo you want detailed changes for a specific file? (yes/no): ").strip().lower()
     if further_choice == 'yes':
         file_name = input("Enter the file name: ").strip()
-        if file_name in changes_summary:
-            display_detailed_changes(file_name, changes_summary[file_name])
+        if file_name in summary.files:
+            display_detailed_changes(file_name, summary.details(file_name))
         else:
             print(f"No changes found for {file_name}.")
 
     save_choice = input("\nSave the change log to a file? (yes/no): ").strip().lower()
     if save_choice == 'yes':
-        output_file = input("Enter the output file name (e.g., changelog.txt): ").strip()
-        save_change_log(changes_summary, output_file)
+        output_file = input("Enter the output file name (e.g., changelog.txt, changelog.jsonl, changelog.csv): ").strip()
+        save_change_log(summary, output_file)
 
 if __name__ == "__main__":
-    folder1, folder2 = input_folders
+    configure_feed_cache(feed_cache_folder, feed_cache_max_mb)
+    if metrics_path:
+        start_metrics('transit_detect', profile_stages, profile_folder)
 
-    changes_summary = compare_folders(folder1, folder2)
-    interactive_menu(changes_summary)
+    if timeline_snapshots:
+        save_change_ledger(compare_timeline(timeline_snapshots, timeline_labels), timeline_ledger_path)
+    else:
+        folder1, folder2 = input_folders
+
+        # Files are compared as the menu asks for their counts or details
+        summary = LazyChangeSummary(folder1, folder2, workers=max_workers, memory_budget_mb=memory_budget_mb)
+        interactive_menu(summary)
+    if metrics_path:
+        stop_metrics().write(metrics_path)
+        print(f"Stage metrics saved to {metrics_path}")
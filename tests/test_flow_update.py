@@ -0,0 +1,97 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'Codes'))
+
+import Flow_Update_Module as flow
+
+def weekday_calendar(service_id, start_date, end_date):
+    return pd.DataFrame([[service_id, 1, 1, 1, 1, 1, 0, 0, start_date, end_date]],
+                        columns=['service_id', *flow.WEEKDAYS, 'start_date', 'end_date'])
+
+def test_renamed_service_matches_across_shifted_windows():
+    cal1 = weekday_calendar('WKDY_W1', 20240101, 20240331)
+    cal2 = weekday_calendar('WKDY_W2', 20240108, 20240407)
+    assert flow.detect_service_id_changes(cal1, cal2) == {'WKDY_W1': 'WKDY_W2'}
+
+def test_stored_decisions_chain_across_feed_pairs(tmp_path):
+    connection = flow.open_mapping_store(str(tmp_path / 'mappings.sqlite'))
+    week1 = pd.Series({'A': 1, 'K': 9})
+    week2 = pd.Series({'B': 2, 'K': 9})
+    week3 = pd.Series({'C': 3, 'K': 9})
+
+    def detect(found):
+        calls = []
+        def matcher(ids1, ids2):
+            calls.append((list(ids1), list(ids2)))
+            return found
+        return matcher, calls
+
+    matcher, calls = detect({'A': 'B'})
+    assert flow.resolve_id_changes(connection, 'stop', week1, week2, matcher) == {'A': 'B'}
+    matcher, calls = detect({'B': 'C'})
+    assert flow.resolve_id_changes(connection, 'stop', week2, week3, matcher) == {'B': 'C'}
+
+    # Week 1 against week 3, and week 2 against week 1, follow the stored decisions
+    matcher, calls = detect({})
+    assert flow.resolve_id_changes(connection, 'stop', week1, week3, matcher) == {'A': 'C'}
+    assert flow.resolve_id_changes(connection, 'stop', week2, week1, matcher) == {'B': 'A'}
+    assert calls == []
+
+    # A changed version is not the one the decision was taken on
+    assert flow.resolve_id_changes(connection, 'stop', pd.Series({'A': 4}), week3, matcher) == {}
+    assert calls == [(['A'], ['C', 'K'])]
+
+def test_stores_without_lineages_are_migrated(tmp_path):
+    path = str(tmp_path / 'mappings.sqlite')
+    connection = flow.open_mapping_store(path)
+    connection.executemany("INSERT INTO id_mappings VALUES (?, ?, ?, ?, ?)",
+                           [('stop', 'A', 1, 'B', 2), ('stop', 'B', 2, 'C', 3)])
+    connection.execute("DELETE FROM entity_versions")
+    connection.commit()
+    connection.close()
+
+    connection = flow.open_mapping_store(path)
+    lineages = connection.execute("SELECT COUNT(DISTINCT lineage), COUNT(*) FROM entity_versions").fetchone()
+    assert lineages == (1, 3)
+    resolved = flow.resolve_id_changes(connection, 'stop', pd.Series({'C': 3}), pd.Series({'A': 1}),
+                                       lambda ids1, ids2: {})
+    assert resolved == {'C': 'A'}
+
+def test_open_ended_services_are_matched_on_a_bounded_window():
+    cal1 = pd.concat([weekday_calendar('WKDY', 20240101, 99991231), weekday_calendar('OLD', 20240101, 20240630)])
+    cal2 = pd.concat([weekday_calendar('WEEKDAY', 20240101, 99991231), weekday_calendar('NEW', 20240101, 20240630)])
+    calD1 = pd.DataFrame({'service_id': ['WKDY'], 'date': [20241225], 'exception_type': [2]})
+    calD2 = pd.DataFrame({'service_id': ['WEEKDAY'], 'date': [20241225], 'exception_type': [2]})
+    assert flow.detect_service_id_changes(cal1, cal2, calD1, calD2) == {'WKDY': 'WEEKDAY', 'OLD': 'NEW'}
+
+    first_day, last_day = flow.service_date_range(cal1, calD1)
+    assert len(flow.service_sample_days(first_day, last_day, (cal1, calD1), (cal2, calD2))) < 50
+
+def test_jittered_and_renamed_stop_is_matched():
+    stops1 = pd.DataFrame({'stop_id': ['S1', 'S2', 'S3'], 'stop_name': ['Central', 'Market', 'Harbour'],
+                           'stop_lat': [45.50000, 45.50010, 45.60000], 'stop_lon': [-73.50000, -73.50010, -73.60000]})
+    # S1 becomes N1, about 10 m away, next to the unchanged Market stop
+    stops2 = pd.DataFrame({'stop_id': ['N1', 'S2', 'S3'], 'stop_name': ['Central', 'Market', 'Harbour'],
+                           'stop_lat': [45.50008, 45.50010, 45.60000], 'stop_lon': [-73.50004, -73.50010, -73.60000]})
+    # Unchanged stops map to themselves
+    assert flow.detect_stop_id_changes(stops1, stops2, tolerance_m=25.0) == {'S1': 'N1', 'S2': 'S2', 'S3': 'S3'}
+    assert 'S1' not in flow.detect_stop_id_changes(stops1, stops2, tolerance_m=5.0)
+
+def test_jittered_and_renamed_shape_is_matched():
+    def shape(shape_id, lats, lons):
+        return pd.DataFrame({'shape_id': shape_id, 'shape_pt_lat': lats, 'shape_pt_lon': lons,
+                             'shape_pt_sequence': range(1, len(lats) + 1)})
+
+    line = [45.5000, 45.5010, 45.5020, 45.5030], [-73.5000, -73.5010, -73.5020, -73.5030]
+    other = [45.6000, 45.6010, 45.6020], [-73.6000, -73.6000, -73.6000]
+    shapes1 = pd.concat([shape('SH1', *line), shape('SH2', *other)], ignore_index=True)
+    # SH1 becomes NSH1, every point moved by about 1 m
+    jittered = [lat + 0.000007 for lat in line[0]], [lon - 0.000006 for lon in line[1]]
+    shapes2 = pd.concat([shape('NSH1', *jittered), shape('SH2', *other)], ignore_index=True)
+
+    # The unchanged shape maps to itself
+    assert flow.detect_shape_id_changes(shapes1, shapes2, tolerance_m=2.0) == {'SH1': 'NSH1', 'SH2': 'SH2'}
+    assert 'SH1' not in flow.detect_shape_id_changes(shapes1, shapes2, tolerance_m=0.5)
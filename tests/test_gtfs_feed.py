@@ -0,0 +1,68 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'Codes'))
+
+import GTFS_Feed_Module as gtfs
+
+STOP_TIMES = ('trip_id,arrival_time,departure_time,stop_id,stop_sequence\n'
+              'T1,08:00:00,08:00:00,S1,1\nT1,,,S2,2\nT1,,,S3,3\nT1,08:10:00,08:10:00,S4,4\n')
+
+def test_blank_time_chunks_are_read_as_missing(tmp_path):
+    (tmp_path / 'stop_times.txt').write_text(STOP_TIMES, encoding='utf-8')
+
+    chunks = list(gtfs.iter_gtfs_table(str(tmp_path), 'stop_times.txt', chunksize=2))
+    assert [chunk['arrival_time'].isna().tolist() for chunk in chunks] == [[False, True], [True, False]]
+
+    (tmp_path / 'stop_times.txt').write_text(STOP_TIMES.replace('08:00:00', '').replace('08:10:00', ''),
+                                             encoding='utf-8')
+    df = gtfs.read_gtfs_table(str(tmp_path), 'stop_times.txt')
+    assert str(df['departure_time'].dtype) == 'Int32'
+    assert df['departure_time'].isna().all()
+
+def multiline_stops(count):
+    # Quoted names spanning two lines, over 1 MB so the parser works on several blocks
+    return 'stop_id,stop_name,stop_lat,stop_lon\n' + ''.join(
+        f'S{i},"Stop\n{i}",45.{i % 1000:03d},-73.1\n' for i in range(count))
+
+def test_multiline_fields_across_parser_blocks(tmp_path):
+    (tmp_path / 'stops.txt').write_text(multiline_stops(60000), encoding='utf-8')
+    assert os.path.getsize(tmp_path / 'stops.txt') > 1 << 20
+
+    df = gtfs.read_gtfs_table(str(tmp_path), 'stops.txt')
+    assert len(df) == 60000
+    assert df['stop_name'].iloc[50000] == 'Stop\n50000'
+
+def test_values_pyarrow_cannot_convert_load_as_with_the_c_engine(tmp_path):
+    (tmp_path / 'stops.txt').write_bytes(b'stop_id,stop_name,stop_lat,stop_lon,location_type\n'
+                                         b'S1,Caf\xe9,45.1,-73.1,0.0\nS2,B,45.2,-73.2,1\n')
+
+    df = gtfs.read_gtfs_table(str(tmp_path), 'stops.txt')
+    expected = gtfs.read_gtfs_table(str(tmp_path), 'stops.txt', engine='c')
+    assert df['location_type'].tolist() == expected['location_type'].tolist() == [0, 1]
+    assert str(df['location_type'].dtype) == 'Int8'
+    assert df['stop_name'].tolist() == ['Café', 'B']
+
+def test_remap_feed_swaps_and_counts_on_categorical_and_object_columns():
+    stops = pd.DataFrame({'stop_id': pd.Categorical(['A', 'B', 'C']),
+                          'parent_station': pd.Categorical([None, 'A', 'A'])})
+    stop_times = pd.DataFrame({'trip_id': ['T1'] * 4, 'stop_id': ['A', 'B', 'B', None]})
+    transfers = pd.DataFrame({'from_stop_id': ['A', 'C'], 'to_stop_id': ['B', 'A']})
+    tables = {'stops.txt': stops, 'stop_times.txt': stop_times, 'transfers.txt': transfers}
+
+    counts = gtfs.remap_feed(tables, {'stop': {'A': 'B', 'B': 'A'}, 'trip': {'T9': 'T1'}})
+
+    assert counts == {
+        'stops.txt': {'stop_id': 2, 'parent_station': 2},
+        'stop_times.txt': {'stop_id': 3},
+        'transfers.txt': {'from_stop_id': 1, 'to_stop_id': 2},
+    }
+    assert isinstance(stops['stop_id'].dtype, pd.CategoricalDtype)
+    assert stops['stop_id'].astype(object).tolist() == ['B', 'A', 'C']
+    assert stops['parent_station'].astype(object).tolist()[1:] == ['B', 'B']
+    assert pd.isna(stops['parent_station'].iloc[0])
+    assert stop_times['stop_id'].tolist()[:3] == ['B', 'A', 'A'] and pd.isna(stop_times['stop_id'].iloc[3])
+    assert stop_times['trip_id'].tolist() == ['T1'] * 4
+    assert transfers.to_dict('list') == {'from_stop_id': ['B', 'C'], 'to_stop_id': ['A', 'B']}
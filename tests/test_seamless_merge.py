@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'Codes'))
+
+import Seamless_Merge_Module as merge
+
+FEED = {
+    'stops.txt': 'stop_id,stop_name,stop_lat,stop_lon,location_type,parent_station\n'
+                 'STA,Central,45.5,-73.5,1,\nP1,Central A,45.5,-73.5,0,STA\nP2,Market,45.6,-73.6,0,\n',
+    'routes.txt': 'route_id,route_short_name,route_type\nR1,1,3\n',
+    'trips.txt': 'route_id,service_id,trip_id,shape_id\nR1,WKDY,T1,SH1\n',
+    'stop_times.txt': 'trip_id,arrival_time,departure_time,stop_id,stop_sequence\n'
+                      'T1,08:00:00,08:00:00,P1,1\nT1,08:10:00,08:10:00,P2,2\n',
+    'calendar.txt': 'service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n'
+                    'WKDY,1,1,1,1,1,0,0,20240101,20241231\n',
+    'shapes.txt': 'shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\nSH1,45.5,-73.5,1\nSH1,45.6,-73.6,2\n',
+}
+
+def write_feed(folder, files):
+    os.makedirs(folder)
+    for file_name, text in files.items():
+        with open(os.path.join(folder, file_name), 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+    return str(folder)
+
+def test_deduplication_rewrites_every_reference(tmp_path):
+    # The second feed publishes the same stops, shape and calendar, and its own trip on a
+    # route of its own
+    feed2 = dict(FEED, **{'routes.txt': FEED['routes.txt'].replace('R1,1,', 'R1,2,')})
+    folders = [write_feed(tmp_path / 'feed1', FEED), write_feed(tmp_path / 'feed2', feed2)]
+    feeds = [merge.add_suffix_to_feed(merge.load_gtfs_files(folder), suffix)
+             for folder, suffix in zip(folders, ['F1', 'F2'])]
+    merged, report = merge.deduplicate_merged_feed(merge.merge_feeds(feeds))
+
+    stops = merged['stops.txt'].astype({'stop_id': str, 'parent_station': object})
+    assert stops['stop_id'].tolist() == ['STA_F1', 'P1_F1', 'P2_F1']
+    assert stops['parent_station'].tolist()[1] == 'STA_F1'
+    assert merged['stop_times.txt']['stop_id'].astype(str).tolist() == ['P1_F1', 'P2_F1'] * 2
+    assert merged['stop_times.txt']['trip_id'].astype(str).tolist() == ['T1_F1'] * 2 + ['T1_F2'] * 2
+    trips = merged['trips.txt'].astype(str)
+    assert trips['shape_id'].tolist() == ['SH1_F1', 'SH1_F1']
+    assert trips['service_id'].tolist() == ['WKDY_F1', 'WKDY_F1']
+    assert trips['route_id'].tolist() == ['R1_F1', 'R1_F2']
+    assert len(merged['routes.txt']) == 2 and len(merged['shapes.txt']) == 2 and len(merged['calendar.txt']) == 1
+
+    assert report['entities'] == {'stop': 3, 'shape': 1, 'service': 1}
+    assert {file: counts['rows'] for file, counts in report.items() if file != 'entities'} == \
+        {'stops.txt': 3, 'shapes.txt': 2, 'calendar.txt': 1}
+    dropped_stops = ('STA_F2,Central,45.5,-73.5,1,\nP1_F2,Central A,45.5,-73.5,0,STA_F2\n'
+                     'P2_F2,Market,45.6,-73.6,0,\n')
+    assert report['stops.txt']['bytes'] == len(dropped_stops.encode('utf-8'))
@@ -0,0 +1,160 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'Codes'))
+
+import Transit_Detect_Module as detect
+
+STOPS = 'stop_id,stop_name,stop_lat,stop_lon\nS1,A,45.1,-73.1\nS2,B,45.2,-73.2\n'
+ROUTES = 'route_id,route_short_name,route_type\nR1,1,3\nR2,2,3\n'
+
+def write_feed(folder, files):
+    os.makedirs(folder)
+    for file_name, text in files.items():
+        with open(os.path.join(folder, file_name), 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+    return str(folder)
+
+def test_pure_append_is_reported_as_added(tmp_path):
+    folder1 = write_feed(tmp_path / 'feed1', {'stops.txt': STOPS})
+    folder2 = write_feed(tmp_path / 'feed2', {'stops.txt': STOPS + 'S3,C,45.3,-73.3\n'})
+
+    changes = detect.compare_folders(folder1, folder2)['stops.txt']
+    assert 'error' not in changes
+    assert changes['added'] == ['S3,C,45.3,-73.3']
+    assert changes['removed'] == []
+    assert detect.count_file_changes('stops.txt', folder1, folder2)['added'] == 1
+
+def test_pure_removal_is_reported_as_removed(tmp_path):
+    folder1 = write_feed(tmp_path / 'feed1', {'routes.txt': ROUTES})
+    folder2 = write_feed(tmp_path / 'feed2', {'routes.txt': ROUTES.replace('R2,2,3\n', '')})
+
+    changes = detect.compare_folders(folder1, folder2)['routes.txt']
+    assert 'error' not in changes
+    assert changes['added'] == []
+    assert changes['removed'] == ['R2,2,3']
+    assert detect.count_file_changes('routes.txt', folder1, folder2)['removed'] == 1
+
+def test_latin1_next_line_byte_stays_inside_its_row(tmp_path):
+    header = b'stop_id,stop_name,stop_lat,stop_lon\r\n'
+    folder1, folder2 = tmp_path / 'feed1', tmp_path / 'feed2'
+    for folder, name in ((folder1, b'Gare\x85Nord'), (folder2, b'Gare\x85Sud')):
+        os.makedirs(folder)
+        (folder / 'stops.txt').write_bytes(header + b'S1,' + name + b',45.1,-73.1\r\nS2,B,45.2,-73.2\r\n')
+
+    changes = detect.compare_folders(str(folder1), str(folder2))['stops.txt']
+    assert changes['added'] == [] and changes['removed'] == []
+    assert changes['modified_rows'] == 1
+    assert changes['attribute_changes']['stop_name'] == [('S1', 'Gare\x85Nord', 'Gare\x85Sud')]
+
+class FailedSummary:
+    files = ['stops.txt']
+
+    def status(self, file):
+        return "Modified"
+
+    def details(self, file, cache=True):
+        return {"added": [], "removed": [], "modified_rows": 0, "attribute_changes": {},
+                "error": "Error comparing attributes: boom"}
+
+    def iter_details(self):
+        yield 'stops.txt', self.details('stops.txt')
+
+def test_text_change_log_reports_comparison_errors(tmp_path, capsys):
+    log = tmp_path / 'changes.txt'
+    detect.save_change_log(FailedSummary(), str(log))
+    assert "Error comparing attributes: boom" in log.read_text(encoding='utf-8')
+
+    detect.display_detailed_changes('stops.txt', FailedSummary().details('stops.txt'))
+    assert "Error comparing attributes: boom" in capsys.readouterr().out
+
+def test_multiline_fields_are_compared_across_parser_blocks(tmp_path):
+    stops = 'stop_id,stop_name,stop_lat,stop_lon\n' + ''.join(
+        f'S{i},"Stop\n{i}",45.{i % 1000:03d},-73.1\n' for i in range(60000))
+    folder1 = write_feed(tmp_path / 'feed1', {'stops.txt': stops})
+    folder2 = write_feed(tmp_path / 'feed2', {'stops.txt': stops.replace('"Stop\n50000"', '"Stop\nFifty"')})
+
+    changes = detect.compare_folders(folder1, folder2)['stops.txt']
+    assert 'error' not in changes
+    assert changes['modified_rows'] == 1
+    assert changes['attribute_changes']['stop_name'] == [('S50000', 'Stop\n50000', 'Stop\nFifty')]
+
+def test_menu_levels_accept_the_compare_folders_dict(tmp_path, capsys):
+    folder1 = write_feed(tmp_path / 'feed1', {'stops.txt': STOPS, 'routes.txt': ROUTES})
+    folder2 = write_feed(tmp_path / 'feed2', {'stops.txt': STOPS + 'S3,C,45.3,-73.3\n', 'routes.txt': ROUTES})
+    changes_summary = detect.compare_folders(folder1, folder2)
+
+    detect.display_high_level_summary(changes_summary)
+    detect.display_mid_level_summary(changes_summary)
+    output = capsys.readouterr().out
+    assert " - stops.txt: Modified" in output and " - routes.txt: No Changes" in output
+    assert " - Added Lines: 1" in output
+
+    lazy_log, dict_log = tmp_path / 'lazy.jsonl', tmp_path / 'dict.jsonl'
+    detect.save_change_log(changes_summary, str(dict_log))
+    detect.save_change_log(detect.LazyChangeSummary(folder1, folder2, workers=2), str(lazy_log))
+    assert sorted(dict_log.read_text(encoding='utf-8').splitlines()) == \
+        sorted(lazy_log.read_text(encoding='utf-8').splitlines())
+
+def test_three_snapshot_ledger(tmp_path):
+    stops = {
+        '2024-01-01': STOPS,
+        '2024-01-08': STOPS.replace('S1,A,', 'S1,A2,') + 'S3,C,45.3,-73.3\n',
+        '2024-01-15': STOPS.replace('S1,A,', 'S1,A2,').replace('S2,B,45.2,-73.2\n', '') + 'S3,C,45.3,-73.3\n',
+    }
+    routes = {'2024-01-01': ROUTES, '2024-01-08': ROUTES, '2024-01-15': ROUTES.replace('R1,1,', 'R1,1A,')}
+    # Every snapshot folder has the same name, only its parent tells them apart
+    snapshots = [write_feed(tmp_path / day / 'gtfs', {'stops.txt': stops[day], 'routes.txt': routes[day]})
+                 for day in stops]
+
+    events = detect.compare_timeline(snapshots)
+    ledger = detect.cumulative_ledger(events).set_index(['file', 'entity_id'])
+    assert ledger.to_dict('index') == {
+        ('routes.txt', 'R1'): {'first_change': '2024-01-15/gtfs', 'last_change': '2024-01-15/gtfs', 'changes': 1,
+                               'history': '2024-01-15/gtfs:modified[route_short_name]'},
+        ('stops.txt', 'S1'): {'first_change': '2024-01-08/gtfs', 'last_change': '2024-01-08/gtfs', 'changes': 1,
+                              'history': '2024-01-08/gtfs:modified[stop_name]'},
+        ('stops.txt', 'S2'): {'first_change': '2024-01-15/gtfs', 'last_change': '2024-01-15/gtfs', 'changes': 1,
+                              'history': '2024-01-15/gtfs:removed'},
+        ('stops.txt', 'S3'): {'first_change': '2024-01-08/gtfs', 'last_change': '2024-01-08/gtfs', 'changes': 1,
+                              'history': '2024-01-08/gtfs:added'},
+    }
+
+    labelled = detect.compare_timeline(snapshots, ['W1', 'W2', 'W3'])
+    assert sorted(labelled['snapshot'].unique()) == ['W2', 'W3']
+
+def test_row_hash_cache_of_another_length_is_recomputed(tmp_path):
+    folder = write_feed(tmp_path / 'feed1', {'stops.txt': STOPS})
+    lines = np.asarray(STOPS.splitlines()[1:], dtype=object)
+    hashes = detect.row_hashes(folder, 'stops.txt', 'digest', lines)
+
+    cache_folder = folder + detect.ROW_HASHES_SUFFIX
+    cached, = os.listdir(cache_folder)
+    assert f'.v{detect.ROW_HASHES_VERSION}.' in cached
+    np.save(os.path.join(cache_folder, cached), hashes[:1])
+    assert np.array_equal(detect.row_hashes(folder, 'stops.txt', 'digest', lines), hashes)
+
+def test_streamed_diff_matches_the_in_memory_diff(tmp_path):
+    header = 'trip_id,arrival_time,departure_time,stop_id,stop_sequence\n'
+    rows1 = [f'T{t},08:{s:02d}:00,08:{s:02d}:00,S{s},{s}' for t in range(150) for s in range(20)]
+    # Duplicate keys, paired in file order: the last T0/1 row changes its stop
+    rows1 += ['T0,09:00:00,09:00:00,SX,1', 'T0,09:05:00,09:05:00,SY,1']
+    rows2 = [row.replace(',S5,', ',S55,') if row.startswith('T7,') else row for row in rows1[:-1]]
+    rows2 = [row for row in rows2 if not row.startswith('T9,')]
+    rows2 += ['T0,09:05:00,09:05:00,SZ,1', 'T999,10:00:00,10:00:00,S1,1']
+    folder1 = write_feed(tmp_path / 'feed1', {'stop_times.txt': header + '\n'.join(rows1) + '\n'})
+    folder2 = write_feed(tmp_path / 'feed2', {'stop_times.txt': header + '\n'.join(rows2) + '\n'})
+
+    in_memory = detect.summarize_file_changes('stop_times.txt', folder1, folder2)
+    # A 40 kB budget spreads the rows over several buckets
+    streamed = detect.summarize_file_changes_streaming('stop_times.txt', folder1, folder2, 0.04,
+                                                       spill_dir=str(tmp_path))
+    assert 'error' not in in_memory and 'error' not in streamed
+    assert in_memory['modified_rows'] == streamed['modified_rows'] == 2
+    assert sorted(in_memory['added']) == sorted(streamed['added'])
+    assert sorted(in_memory['removed']) == sorted(streamed['removed'])
+    assert len(streamed['removed']) == 20 and len(streamed['added']) == 1
+    assert {attr: sorted(values) for attr, values in in_memory['attribute_changes'].items()} == \
+        {attr: sorted(values) for attr, values in streamed['attribute_changes'].items()}